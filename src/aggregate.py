@@ -0,0 +1,310 @@
+import json
+import math
+import numpy as np
+from pathlib import Path
+import src.memory as mem
+from src.governor import ResourceGovernor, frame_bytes
+from src.sparseflow import SparseFlow
+
+class Moments():
+    def __init__(self):
+        """
+        Mergeable count, mean, variance, min and max (Chan et al. parallel update).
+        """
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def update(self, values : np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        if values.size == 0:
+            return
+        other = Moments()
+        other.count = values.size
+        other.mean = float(values.mean())
+        other.m2 = float(((values - other.mean)**2).sum())
+        other.min = float(values.min())
+        other.max = float(values.max())
+        self.merge(other)
+
+    def merge(self, other : 'Moments') -> None:
+        if other.count == 0:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta**2 * self.count * other.count / count
+        self.count = count
+        self.min = min(self.min, other.min)
+        self.max = max(self.max, other.max)
+
+    def summary(self) -> dict:
+        var = self.m2 / self.count if self.count else math.nan
+        return {'count': self.count, 'mean': self.mean if self.count else math.nan, 'std': math.sqrt(var),
+                'min': self.min if self.count else math.nan, 'max': self.max if self.count else math.nan}
+
+class Histogram():
+    def __init__(self, edges : np.ndarray):
+        """
+        Mergeable histogram with fixed bin edges. Values outside the edges are counted separately.
+        """
+        self.edges = np.asarray(edges, dtype=np.float64)
+        self.counts = np.zeros(len(self.edges) - 1, dtype=np.int64)
+        self.under = 0
+        self.over = 0
+
+    def update(self, values : np.ndarray) -> None:
+        values = np.asarray(values).ravel()
+        self.counts += np.histogram(values, bins=self.edges)[0]
+        self.under += int((values < self.edges[0]).sum())
+        self.over += int((values > self.edges[-1]).sum())
+
+    def merge(self, other : 'Histogram') -> None:
+        assert np.array_equal(self.edges, other.edges), "Histograms must share bin edges"
+        self.counts += other.counts
+        self.under += other.under
+        self.over += other.over
+
+    def summary(self) -> dict:
+        return {'edges': self.edges.tolist(), 'counts': self.counts.tolist(), 'under': self.under, 'over': self.over}
+
+class QuantileSketch():
+    def __init__(self, relative_accuracy : float = 0.01, min_value : float = 1e-6):
+        """
+        Mergeable quantile sketch for non-negative values (logarithmic buckets, as in DDSketch).
+
+        Every quantile is returned within `relative_accuracy` of the true value; values below
+        `min_value` are treated as zero. Merging adds bucket counts, so the result doesn't depend
+        on how the data was split between workers.
+
+        Args:
+            relative_accuracy (float): Relative error bound of the quantiles. Default is 0.01.
+            min_value (float): Smallest value distinguished from zero. Default is 1e-6.
+        """
+        self.relative_accuracy = relative_accuracy
+        self.min_value = min_value
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.offset = int(math.floor(math.log(min_value) / math.log(self.gamma)))
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.zeros = 0
+
+    def update(self, values : np.ndarray) -> None:
+        values = np.asarray(values, dtype=np.float64).ravel()
+        small = values < self.min_value
+        self.zeros += int(small.sum())
+        keys = np.ceil(np.log(values[~small]) / math.log(self.gamma)).astype(np.int64) - self.offset
+        if keys.size == 0:
+            return
+        counts = np.bincount(keys)
+        self._add(counts)
+
+    def _add(self, counts : np.ndarray) -> None:
+        if len(counts) > len(self.counts):
+            counts = counts.copy()
+            counts[:len(self.counts)] += self.counts
+            self.counts = counts
+        else:
+            self.counts[:len(counts)] += counts
+
+    def merge(self, other : 'QuantileSketch') -> None:
+        assert self.gamma == other.gamma and self.offset == other.offset, "Sketches must share parameters"
+        self.zeros += other.zeros
+        self._add(other.counts)
+
+    def quantile(self, q : float) -> float:
+        total = self.zeros + int(self.counts.sum())
+        if total == 0:
+            return math.nan
+        rank = q * (total - 1)
+        if rank < self.zeros:
+            return 0.0
+        key = int(np.searchsorted(np.cumsum(self.counts), rank - self.zeros, side='right'))
+        return 2 * self.gamma**(key + self.offset) / (self.gamma + 1)
+
+    def summary(self, quantiles : tuple = (0.05, 0.25, 0.5, 0.75, 0.95)) -> dict:
+        return {f"q{round(q * 100)}": self.quantile(q) for q in quantiles}
+
+class FlowStats():
+    def __init__(self, max_speed : float = 20.0, bins : int = 100):
+        """
+        All accumulators for one flow (or a pool of flows): moments of dx, dy and speed, a speed
+        histogram on [0, max_speed] and a speed quantile sketch.
+
+        Args:
+            max_speed (float): Upper edge of the speed histogram in px/frame. Default is 20.
+            bins (int): Number of histogram bins. Default is 100.
+        """
+        self.dx = Moments()
+        self.dy = Moments()
+        self.speed = Moments()
+        self.histogram = Histogram(np.linspace(0, max_speed, bins + 1))
+        self.sketch = QuantileSketch()
+
+    def update(self, vectors : np.ndarray) -> None:
+        """
+        Adds flow vectors of shape (..., 2).
+        """
+        dx, dy = vectors[..., 0], vectors[..., 1]
+        speed = np.hypot(dx, dy)
+        self.dx.update(dx)
+        self.dy.update(dy)
+        self.speed.update(speed)
+        self.histogram.update(speed)
+        self.sketch.update(speed)
+
+    def merge(self, other : 'FlowStats') -> None:
+        self.dx.merge(other.dx)
+        self.dy.merge(other.dy)
+        self.speed.merge(other.speed)
+        self.histogram.merge(other.histogram)
+        self.sketch.merge(other.sketch)
+
+    def summary(self) -> dict:
+        return {'dx': self.dx.summary(), 'dy': self.dy.summary(),
+                'speed': {**self.speed.summary(), **self.sketch.summary()},
+                'histogram': self.histogram.summary()}
+
+def find_stacks(stacktype : str = None, start_date : str = None, end_date : str = None) -> list:
+    """
+    Finds the saved stacks of a cell type, optionally within a date range.
+
+    Stacks are named 'DATE_CELLTYPE'; the date is compared as a string (e.g. '20220929'), both ends
+    of the range are inclusive.
+
+    Args:
+        stacktype (str, optional): Cell type, as saved in meta.json. Default is None (every type).
+        start_date (str, optional): First date to include. Default is None (no lower bound).
+        end_date (str, optional): Last date to include. Default is None (no upper bound).
+
+    Returns:
+        list[str]: Names of the matching stacks.
+    """
+    names = []
+    for meta_path in sorted(mem.main_path.glob('*/meta.json')):
+        with open(meta_path, 'r') as f:
+            meta = json.load(f)
+        if stacktype is not None and meta.get('stacktype') != stacktype:
+            continue
+        date = meta['name'].split('_', 1)[0]
+        if (start_date is not None and date < start_date) or (end_date is not None and date > end_date):
+            continue
+        names.append(meta['name'])
+    return names
+
+def latest_flow(name : str, ftag=None) -> Path:
+    """
+    Returns a flow artifact of a stack: the one with tag ftag, or the latest one (dense .npy or sparse .npz).
+
+    Returns:
+        Path: Path of the flow, None if the stack has none.
+    """
+    flow_dir = mem.main_path / name / 'flow'
+    if ftag is not None:
+        for suffix in ('.npy', '.npz'):
+            path = flow_dir / f"{name}_f{ftag}{suffix}"
+            if path.exists():
+                return path
+        return None
+
+    def tag(path):
+        t = path.stem[len(name) + 2:]
+        return int(t) if t.isdigit() else -1
+    flows = [p for p in flow_dir.glob(f"{name}_f*") if p.suffix in ('.npy', '.npz') and tag(p) >= 0]
+    return max(flows, key=tag) if flows else None
+
+def summarize_flow(args) -> FlowStats:
+    """
+    Streams one flow artifact through a FlowStats, a chunk of frames at a time.
+
+    Args:
+        args (tuple): (path, channel, chunk_bytes, max_speed, bins).
+            - path: Path of a dense (.npy) or sparse (.npz) flow.
+            - channel: Channel to summarize, for flows with channels.
+            - chunk_bytes: Memory this worker may use for one chunk of frames.
+            - max_speed, bins: Histogram parameters (see FlowStats).
+
+    Returns:
+        FlowStats: Accumulators of the flow.
+    """
+    path, channel, chunk_bytes, max_speed, bins = args
+    stats = FlowStats(max_speed, bins)
+
+    if path.suffix == '.npz':
+        # the sparse values are already compact, so only the selected channel is kept around
+        sflow = SparseFlow.load(path)
+        values = sflow.values[:, channel]
+        step = max(chunk_bytes // (4 * frame_bytes((2,), values.dtype)), 1)
+        for start in range(0, len(values), step):
+            stats.update(values[start:start + step])
+        return stats
+
+    arr = np.load(path, mmap_mode='r')
+    if arr.ndim == 5:
+        arr = arr[:, channel]
+    per_frame = 4 * frame_bytes(arr.shape[1:], np.float64) # vectors, speed and temporaries
+    step = max(chunk_bytes // per_frame, 1)
+    for start in range(0, arr.shape[0], step):
+        stats.update(np.asarray(arr[start:start + step]))
+    return stats
+
+def aggregate(stacktype : str = None, start_date : str = None, end_date : str = None, channel : int = 0,
+              ftag=None, max_speed : float = 20.0, bins : int = 100,
+              governor : ResourceGovernor = None, save : bool = True) -> dict:
+    """
+    Summarizes the flows of every stack of a cell type and/or date range, per stack and pooled, in parallel.
+
+    Every stack is streamed by its own worker in chunks of frames, into mergeable accumulators
+    (moments, histogram, quantile sketch). The per-stack accumulators are then merged into the
+    pooled summary, so no worker ever holds more than one chunk of a flow.
+
+    The report is saved as CellFlow/reports/<stacktype>/<stacktype>_ai.json ('all' without a stacktype).
+
+    Args:
+        stacktype (str, optional): Cell type to aggregate. Default is None (every type).
+        start_date (str, optional): First date to include (see find_stacks). Default is None.
+        end_date (str, optional): Last date to include (see find_stacks). Default is None.
+        channel (int): Flow channel to summarize. Default is 0 (the summed flow).
+        ftag (int | str, optional): Tag of the flow to use in every stack. Default is the latest flow.
+        max_speed (float): Upper edge of the speed histogram in px/frame. Default is 20.
+        bins (int): Number of histogram bins. Default is 100.
+        governor (ResourceGovernor, optional): Memory/worker budget. Default is a new governor.
+        save (bool): Save the report. Default is True.
+
+    Returns:
+        dict: The report, with 'stacks' (per-stack summaries) and 'pooled'.
+    """
+    governor = governor or ResourceGovernor()
+    flows = {}
+    for name in find_stacks(stacktype, start_date, end_date):
+        path = latest_flow(name, ftag)
+        if path is None:
+            print(f"[WARNING] {name} has no flow to aggregate")
+        else:
+            flows[name] = path
+
+    report = {'stacktype': stacktype, 'start_date': start_date, 'end_date': end_date,
+              'channel': channel, 'stacks': {}, 'pooled': None}
+    if flows:
+        # every worker needs at least one frame in flight, the rest of its share goes into larger chunks
+        frame_cost = max(4 * frame_bytes(np.load(p, mmap_mode='r').shape[-3:], np.float64) if p.suffix == '.npy' else 0
+                         for p in flows.values())
+        _, workers = governor.plan('aggregate', len(flows), frame_cost)
+        chunk_bytes = governor.max_memory // workers
+        jobs = [(path, channel, chunk_bytes, max_speed, bins) for path in flows.values()]
+        with governor.executor(workers) as ex:
+            results = ex.map(summarize_flow, jobs)
+
+        pooled = FlowStats(max_speed, bins)
+        for (name, path), stats in zip(flows.items(), results):
+            report['stacks'][name] = {'flow': path.name, **stats.summary()}
+            pooled.merge(stats)
+        report['pooled'] = pooled.summary()
+
+    if save:
+        group = stacktype or 'all'
+        report_path = mem.get_unique_path('reports', group, lambda i: f"{group}_a{i}.json")
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+    return report
@@ -0,0 +1,155 @@
+import os
+import time
+import cv2
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool, cpu_count
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+BACKENDS = ('thread', 'process', 'serial')
+THREAD_ENV_VARS = ('OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS', 'NUMEXPR_NUM_THREADS')
+
+def _limit_threads(n : int) -> None:
+    """
+    Limits OpenCV (and, if threadpoolctl is installed, BLAS/OpenMP) to n internal threads.
+    """
+    cv2.setNumThreads(n)
+    if threadpool_limits is not None:
+        threadpool_limits(n)
+
+class Executor():
+    def __init__(self, backend : str = 'process', workers : int = None, total_threads : int = None):
+        """
+        Maps a function over items with a thread pool, a process pool, or serially.
+
+        OpenCV releases the GIL, so its calls run in parallel from a thread pool without the process
+        start-up, pickling and result copies of multiprocessing. Either way, the machine's thread
+        budget (`total_threads`) is split between the workers: each worker's OpenCV gets
+        total_threads // workers internal threads, so the workers don't oversubscribe the cores.
+        The serial backend gives the whole budget to OpenCV's own threading instead.
+
+        BLAS/OpenMP are only capped the same way if threadpoolctl is installed. Without it, spawned
+        worker processes still pick up the limit from OMP_NUM_THREADS etc., but forked workers and
+        the thread and serial backends keep whatever BLAS/OpenMP pools are already running.
+
+        Use it as a context manager; `map` has the same semantics as multiprocessing.Pool.map.
+
+        Args:
+            backend (str): One of 'thread', 'process' or 'serial'. Default is 'process'.
+            workers (int, optional): Number of workers. Default is cpu_count().
+            total_threads (int, optional): Thread budget for the whole machine. Default is cpu_count().
+
+        Attributes:
+            backend (str): Chosen backend.
+            workers (int): Number of workers (1 for serial).
+            threads_per_worker (int): Internal OpenCV (and, with threadpoolctl, BLAS) threads each worker may use.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f"Invalid backend. Expected one of {BACKENDS}, but got {backend}")
+        total_threads = total_threads or cpu_count()
+        self.backend = backend
+        self.workers = 1 if backend == 'serial' else max(int(workers or cpu_count()), 1)
+        self.threads_per_worker = max(total_threads // self.workers, 1)
+        self._pool = None
+        self._prev_threads = None
+        self._blas_limits = None
+
+    def __enter__(self):
+        self._prev_threads = cv2.getNumThreads()
+        if self.backend == 'process':
+            # spawned workers read these when they start. Forked ones inherit the running BLAS/OpenMP
+            # pools, which the initializer only limits if threadpoolctl is installed (OpenCV always)
+            saved = {k: os.environ.get(k) for k in THREAD_ENV_VARS}
+            os.environ.update({k: str(self.threads_per_worker) for k in THREAD_ENV_VARS})
+            try:
+                self._pool = Pool(self.workers, initializer=_limit_threads, initargs=(self.threads_per_worker,))
+            finally:
+                for k, v in saved.items():
+                    if v is None:
+                        os.environ.pop(k, None)
+                    else:
+                        os.environ[k] = v
+        else:
+            # threads share one OpenCV (and BLAS/OpenMP) thread pool, so the limit is set once, in this process
+            # (BLAS/OpenMP only if threadpoolctl is installed)
+            cv2.setNumThreads(self.threads_per_worker)
+            if threadpool_limits is not None:
+                self._blas_limits = threadpool_limits(self.threads_per_worker)
+            if self.backend == 'thread':
+                self._pool = ThreadPoolExecutor(self.workers)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.backend == 'process':
+            self._pool.terminate()
+            self._pool.join()
+        elif self.backend == 'thread':
+            self._pool.shutdown()
+        self._pool = None
+        cv2.setNumThreads(self._prev_threads)
+        if self._blas_limits is not None:
+            self._blas_limits.restore_original_limits()
+            self._blas_limits = None
+
+    def map(self, func, items) -> list:
+        """
+        Applies func to every item and returns the results in order.
+
+        Args:
+            func (callable): Function to apply. Must be picklable for the process backend.
+            items (iterable): Items to map over.
+
+        Returns:
+            list: Results, in the order of items.
+        """
+        if self.backend == 'process':
+            return self._pool.map(func, items)
+        if self.backend == 'thread':
+            return list(self._pool.map(func, items))
+        return [func(item) for item in items]
+
+def benchmark_backends(frame_sizes : list = ((256, 256), (512, 512), (520, 2329), (1024, 1024)),
+                       n_frames : int = 16, backends : tuple = BACKENDS, workers : int = None,
+                       flow_args : dict = None, verbose : bool = True) -> list:
+    """
+    Times preprocessing + Farneback flow on synthetic stacks for every backend and frame size.
+
+    Args:
+        frame_sizes (list[tuple]): (H, W) sizes to test.
+        n_frames (int): Frames per synthetic stack. Default is 16.
+        backends (tuple[str]): Backends to compare. Default is all of them.
+        workers (int, optional): Workers for the pooled backends. Default is cpu_count().
+        flow_args (dict, optional): Optical flow parameters. Default is defaults.default_flow.
+        verbose (bool): Print a table of the results. Default is True.
+
+    Returns:
+        list[dict]: One entry per (frame size, backend) with 'seconds' and 'pairs_per_s'.
+    """
+    from src.defaults import default_process, default_flow
+    from src.flow import preprocess_frame, compute_flow_pair
+
+    flow_args = flow_args or default_flow
+    rng = np.random.default_rng(0)
+    results = []
+    for h, w in frame_sizes:
+        base = cv2.GaussianBlur(rng.integers(0, 65535, (h, w), dtype=np.uint16), (0, 0), 2)
+        stack = [np.roll(base, (i, 2 * i), axis=(0, 1)) for i in range(n_frames)]
+        for backend in backends:
+            start = time.perf_counter() # includes pool start-up
+            with Executor(backend, workers) as ex:
+                processed = ex.map(preprocess_frame, [(f, default_process) for f in stack])
+                ex.map(compute_flow_pair, [(processed[i], processed[i+1], flow_args) for i in range(n_frames - 1)])
+                seconds = time.perf_counter() - start
+            results.append({'frame_size': (h, w), 'backend': backend, 'workers': ex.workers,
+                            'seconds': seconds, 'pairs_per_s': (n_frames - 1) / seconds})
+
+    if verbose:
+        print(f"{'frame size':>12} {'backend':>8} {'workers':>8} {'seconds':>9} {'pairs/s':>9}")
+        for r in results:
+            size = f"{r['frame_size'][0]}x{r['frame_size'][1]}"
+            print(f"{size:>12} {r['backend']:>8} {r['workers']:>8} {r['seconds']:>9.3f} {r['pairs_per_s']:>9.1f}")
+    return results
@@ -0,0 +1,146 @@
+import numpy as np
+from scipy import fft
+from src.governor import ResourceGovernor, frame_bytes
+from src.flowresult import FlowResult
+
+def _radial_bins(shape : tuple, max_r : int) -> tuple:
+    """
+    Integer distance of every displacement in a padded correlation map (FFT wrap-around order).
+
+    Returns:
+        tuple: (flat bin index of every map entry, number of entries per bin), distances >= max_r
+        are put into bin max_r, which is dropped afterwards.
+    """
+    dy = np.fft.fftfreq(shape[0], 1 / shape[0])
+    dx = np.fft.fftfreq(shape[1], 1 / shape[1])
+    r = np.rint(np.hypot(dy[:, None], dx[None, :])).astype(np.int64)
+    bins = np.minimum(r, max_r).ravel()
+    return bins, np.bincount(bins, minlength=max_r + 1)
+
+def _select_channel(flow, channel : int) -> np.ndarray:
+    """
+    Returns the (T, H, W, 2) flow of one channel, without reading it, from a FlowResult or an array
+    of shape (T, H, W, 2) or (T, C, H, W, 2).
+    """
+    if isinstance(flow, FlowResult):
+        flow = flow.view(channel)
+    elif flow.ndim == 5:
+        flow = flow[:, channel]
+    assert flow.ndim == 4 and flow.shape[-1] == 2, f"Expected a flow of shape (T, H, W, 2), got {flow.shape}"
+    return flow
+
+def spatial_autocorrelation(flow : np.ndarray, max_r : int = None, subtract_mean : bool = True,
+                            governor : ResourceGovernor = None, channel : int = 0) -> tuple:
+    """
+    Computes the radially averaged spatial velocity autocorrelation of every frame.
+
+    C(r) = <v(x) . v(x + d)> / <v(x) . v(x)>, averaged over all positions x and all displacements
+    d with |d| = r. It is computed with zero-padded float32 FFTs (Wiener-Khinchin) over chunks of
+    frames sized by the governor, so a memory-mapped flow is never loaded as a whole. Frames are
+    padded by max_r to a fast FFT length, which is enough to avoid wrap-around up to max_r.
+
+    Args:
+        flow (np.ndarray | FlowResult): Flow of shape (T, H, W, 2) or (T, C, H, W, 2), or a FlowResult.
+        max_r (int, optional): Largest distance in pixels. Default is min(H, W) // 2. Distances
+            beyond the frame diagonal have no pixel pairs and come out as NaN.
+        subtract_mean (bool): Subtract each frame's mean velocity first, so collective drift doesn't
+            dominate the correlation. Default is True.
+        governor (ResourceGovernor, optional): Decides the chunk size. Default is a new governor.
+        channel (int): Channel to use if the flow has channels. Default is 0 (the summed flow).
+
+    Returns:
+        tuple: (r, corr), r of shape (max_r,) in pixels and corr of shape (T, max_r).
+    """
+    flow = _select_channel(flow, channel)
+    T, H, W = flow.shape[:3]
+    max_r = max_r or min(H, W) // 2
+    governor = governor or ResourceGovernor()
+    shape = (fft.next_fast_len(H + max_r, real=True), fft.next_fast_len(W + max_r, real=True))
+    # padded input, complex spectra of both components and the correlation map, in float32
+    chunk_size, _ = governor.plan('spatial correlation', T, 6 * frame_bytes(shape, np.float32) + frame_bytes((H, W, 2), flow.dtype))
+
+    ones = fft.rfft2(np.ones((H, W), dtype=np.float32), s=shape)
+    overlap = fft.irfft2(ones * np.conj(ones), s=shape) # number of pairs per displacement
+    overlap = np.rint(overlap).ravel()
+    valid = overlap > 0 # displacements longer than the frame have no pairs and are left out
+    bins, _ = _radial_bins(shape, max_r)
+    bins, overlap = bins[valid], overlap[valid]
+    counts = np.bincount(bins, minlength=max_r + 1)[:max_r]
+
+    corr = np.empty((T, max_r))
+    for start in range(0, T, chunk_size):
+        v = np.asarray(flow[start:start + chunk_size], dtype=np.float32)
+        if subtract_mean:
+            v = v - v.mean(axis=(1, 2), keepdims=True)
+        spectrum = fft.rfft2(v, s=shape, axes=(1, 2), workers=governor.max_workers)
+        power = (spectrum.real**2 + spectrum.imag**2).sum(axis=-1)
+        c = fft.irfft2(power, s=shape, axes=(1, 2), workers=governor.max_workers).reshape(len(v), -1)[:, valid] / overlap
+        for i, frame in enumerate(c):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                radial = np.bincount(bins, weights=frame, minlength=max_r + 1)[:max_r] / counts
+            corr[start + i] = radial / radial[0] if radial[0] > 0 else np.nan
+    return np.arange(max_r), corr
+
+def temporal_autocorrelation(flow : np.ndarray, max_lag : int = None, subtract_mean : bool = False,
+                             governor : ResourceGovernor = None, channel : int = 0) -> tuple:
+    """
+    Computes the temporal velocity autocorrelation, averaged over all pixels.
+
+    C(tau) = <v(x, t) . v(x, t + tau)> / <v(x, t) . v(x, t)>, averaged over x and t. It is computed
+    with zero-padded float32 FFTs along time, over blocks of image rows sized by the governor.
+
+    Args:
+        flow (np.ndarray | FlowResult): Flow of shape (T, H, W, 2) or (T, C, H, W, 2), or a FlowResult.
+        max_lag (int, optional): Largest lag in frames. Default is T - 1.
+        subtract_mean (bool): Subtract every pixel's mean velocity over time first. Default is False.
+        governor (ResourceGovernor, optional): Decides the block size. Default is a new governor.
+        channel (int): Channel to use if the flow has channels. Default is 0 (the summed flow).
+
+    Returns:
+        tuple: (lags, corr), both of shape (max_lag + 1,).
+    """
+    flow = _select_channel(flow, channel)
+    T, H, W = flow.shape[:3]
+    max_lag = min(max_lag if max_lag is not None else T - 1, T - 1)
+    governor = governor or ResourceGovernor()
+    n = fft.next_fast_len(T + max_lag, real=True)
+    chunk_size, _ = governor.plan('temporal correlation', H, 6 * frame_bytes((n, W, 2), np.float32))
+
+    total = np.zeros(max_lag + 1)
+    for start in range(0, H, chunk_size):
+        v = np.asarray(flow[:, start:start + chunk_size], dtype=np.float32)
+        if subtract_mean:
+            v = v - v.mean(axis=0, keepdims=True)
+        spectrum = fft.rfft(v, n=n, axis=0, workers=governor.max_workers)
+        c = fft.irfft(spectrum.real**2 + spectrum.imag**2, n=n, axis=0, workers=governor.max_workers)[:max_lag + 1]
+        total += c.sum(axis=tuple(range(1, c.ndim)), dtype=np.float64)
+
+    lags = np.arange(max_lag + 1)
+    total /= (T - lags) # number of (t, t + tau) pairs
+    corr = total / total[0] if total[0] > 0 else np.full(max_lag + 1, np.nan)
+    return lags, corr
+
+def correlation_length(r : np.ndarray, corr : np.ndarray, threshold : float = np.exp(-1)) -> np.ndarray:
+    """
+    Extracts the correlation length: the distance where the correlation first drops below threshold.
+
+    The crossing is linearly interpolated between the two neighbouring distances.
+
+    Args:
+        r (np.ndarray): Distances of shape (R,).
+        corr (np.ndarray): Correlation of shape (R,) or (T, R), e.g. from spatial_autocorrelation.
+        threshold (float): Threshold value. Default is 1/e.
+
+    Returns:
+        np.ndarray: Correlation length per frame (scalar array for 1D input). NaN if never crossed.
+    """
+    single = np.ndim(corr) == 1
+    corr = np.atleast_2d(corr)
+    lengths = np.full(corr.shape[0], np.nan)
+    for i, c in enumerate(corr):
+        below = np.flatnonzero(c < threshold)
+        if len(below) == 0 or below[0] == 0:
+            continue
+        j = below[0]
+        lengths[i] = r[j - 1] + (c[j - 1] - threshold) / (c[j - 1] - c[j]) * (r[j] - r[j - 1])
+    return lengths[0] if single else lengths
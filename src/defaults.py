@@ -11,4 +11,25 @@ default_flow = {'pyr_scale' : 0.5,
                                 'poly_n' : 5,
                                 'poly_sigma' : 1.2,
                                 'flag' : 0}
-default_trajectory = {} # empty until properly implemented
\ No newline at end of file
+default_trajectory = {} # empty until properly implemented
+default_mask = {'thresh' : None,
+                                'open' : 5,
+                                'close' : 9,
+                                'min_area' : 64,
+                                'dilate' : 15,
+                                'tile' : 64,
+                                'pad' : 32}
+default_tracking = {'max_corners' : 500,
+                                'quality_level' : 0.01,
+                                'min_distance' : 7,
+                                'block_size' : 7,
+                                'win_size' : 21,
+                                'max_level' : 3,
+                                'fb_threshold' : 1.0,
+                                'redetect' : 0.8}
+default_multi_lag = {'lags' : [1, 2, 4, 8],
+                                'stride' : 1}
+default_smooth = {'temporal' : 'median',
+                                'window' : 5,
+                                'alpha' : 0.5,
+                                'sigma' : 1.0}
\ No newline at end of file
@@ -0,0 +1,314 @@
+import time
+import json
+import itertools
+import cv2
+import numpy as np
+import tifffile as tiff
+from pathlib import Path
+import src.memory as mem
+from src.flow import preprocess_frame, compute_flow_pair
+from src.governor import ResourceGovernor, frame_bytes
+from src.defaults import default_process, default_flow
+
+EXAMPLE_TIFF = Path(__file__).resolve().parent.parent / 'example_notebooks' / 'example_images' / '20220929_MCF_Rab5a_WH_heterotypic_s1_SCALED.tif'
+FIELDS = ('translation', 'rotation', 'shear', 'vortex', 'random')
+
+def synthetic_texture(shape : tuple = (256, 256), seed : int = 0, sigma : float = 2.0, dtype=np.uint16) -> np.ndarray:
+    """
+    Makes a blurred noise texture, a stand-in for a microscopy frame when no real one is available.
+
+    Args:
+        shape (tuple): (H, W) of the frame. Default is (256, 256).
+        seed (int): Random seed. Default is 0.
+        sigma (float): Blur in pixels, i.e. roughly the size of the texture's blobs. Default is 2.0.
+        dtype (np.dtype): Data type of the frame. Default is np.uint16.
+
+    Returns:
+        np.ndarray: Frame of shape (H, W).
+    """
+    rng = np.random.default_rng(seed)
+    frame = cv2.GaussianBlur(rng.random(shape, dtype=np.float32), (0, 0), sigma)
+    frame = cv2.normalize(frame, None, 0, 1, cv2.NORM_MINMAX)
+    return (frame * np.iinfo(dtype).max).astype(dtype) if np.issubdtype(dtype, np.integer) else frame.astype(dtype)
+
+def load_reference_frame(path=EXAMPLE_TIFF, channel : int = 1, n_channels : int = 3, frame : int = 0) -> np.ndarray:
+    """
+    Reads one frame of one channel from a TIFF stack.
+
+    Args:
+        path (str | Path): TIFF stack. Default is the bundled example stack.
+        channel (int): Channel to read. Default is 1.
+        n_channels (int): Number of channels in the stack. Default is 3.
+        frame (int): Frame to read. Default is 0.
+
+    Returns:
+        np.ndarray: Frame of shape (H, W), or None if the file can't be read (e.g. the example
+        stack was checked out as a Git LFS pointer).
+    """
+    try:
+        with tiff.TiffFile(path) as img:
+            return img.pages[frame * n_channels + channel].asarray()
+    except Exception as e:
+        print(f"[WARNING] Could not read reference frame from {path}: {e}")
+        return None
+
+def displacement_field(shape : tuple, kind : str = 'vortex', magnitude : float = 3.0, seed : int = 0) -> np.ndarray:
+    """
+    Makes a known displacement field.
+
+    Args:
+        shape (tuple): (H, W) of the frame.
+        kind (str): One of FIELDS. Default is 'vortex'.
+            - translation: the same shift everywhere.
+            - rotation: rigid rotation about the center.
+            - shear: horizontal shift growing linearly with y.
+            - vortex: rotation that peaks at a radius of a quarter frame and decays outside.
+            - random: smooth random field.
+        magnitude (float): Largest displacement in pixels. Default is 3.0.
+        seed (int): Random seed for 'random'. Default is 0.
+
+    Returns:
+        np.ndarray: Field of shape (H, W, 2) holding (dx, dy), in the convention of OpenCV's flow.
+    """
+    h, w = shape
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    cy, cx = (h - 1) / 2, (w - 1) / 2
+    if kind == 'translation':
+        u = np.full((h, w), magnitude * 0.8, np.float32)
+        v = np.full((h, w), magnitude * 0.6, np.float32)
+    elif kind == 'rotation':
+        u, v = -(y - cy), x - cx
+    elif kind == 'shear':
+        u, v = y - cy, np.zeros((h, w), np.float32)
+    elif kind == 'vortex':
+        r0 = min(h, w) / 4
+        r = np.hypot(x - cx, y - cy) + 1e-6
+        speed = (r / r0) * np.exp(1 - r / r0)
+        u, v = -(y - cy) / r * speed, (x - cx) / r * speed
+    elif kind == 'random':
+        rng = np.random.default_rng(seed)
+        sigma = min(h, w) / 8
+        u = cv2.GaussianBlur(rng.standard_normal((h, w)).astype(np.float32), (0, 0), sigma)
+        v = cv2.GaussianBlur(rng.standard_normal((h, w)).astype(np.float32), (0, 0), sigma)
+    else:
+        raise ValueError(f"Unknown displacement field: {kind}")
+
+    field = np.stack([u, v], axis=-1).astype(np.float32)
+    peak = np.hypot(field[..., 0], field[..., 1]).max()
+    return field * (magnitude / peak) if peak > 0 else field
+
+def warp_frame(frame : np.ndarray, field : np.ndarray, iterations : int = 5) -> tuple:
+    """
+    Moves every pixel of a frame by a known displacement field.
+
+    The field is defined on the first frame (pixel x moves to x + field(x)), which is what dense
+    flow estimates. cv2.remap needs the inverse map, so it is found by fixed-point iteration
+    b(y) = -field(y + b(y)).
+
+    Args:
+        frame (np.ndarray): Frame (H, W).
+        field (np.ndarray): Displacement field (H, W, 2), e.g. from displacement_field.
+        iterations (int): Fixed-point iterations for the inverse map. Default is 5.
+
+    Returns:
+        tuple: (warped, valid), the second frame and a boolean mask (H, W) of the pixels of the first
+        frame whose destination lies inside the image.
+    """
+    h, w = frame.shape
+    y, x = np.mgrid[0:h, 0:w].astype(np.float32)
+    back = -field.copy()
+    for _ in range(iterations):
+        back = -cv2.remap(field, x + back[..., 0], y + back[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+    warped = cv2.remap(frame, x + back[..., 0], y + back[..., 1], cv2.INTER_LINEAR, borderMode=cv2.BORDER_REFLECT)
+    dest_x, dest_y = x + field[..., 0], y + field[..., 1]
+    valid = (dest_x >= 0) & (dest_x <= w - 1) & (dest_y >= 0) & (dest_y <= h - 1)
+    return warped, valid
+
+def make_cases(frame : np.ndarray = None, shape : tuple = (256, 256), fields : tuple = FIELDS,
+               magnitude : float = 3.0, margin : int = 8) -> list:
+    """
+    Builds evaluation cases: a frame, its warped copy and the true flow between them.
+
+    Args:
+        frame (np.ndarray, optional): Real frame to warp. Default is the bundled example frame, or a
+            synthetic texture of the given shape if it can't be read.
+        shape (tuple): (H, W) of the synthetic texture. Default is (256, 256).
+        fields (tuple[str]): Displacement fields to use (see displacement_field). Default is all of them.
+        magnitude (float): Largest displacement in pixels. Default is 3.0.
+        margin (int): Border in pixels that is left out of the error, where every method is unreliable. Default is 8.
+
+    Returns:
+        list[dict]: One case per field, with 'field', 'f1', 'f2', 'flow' (H, W, 2) and 'valid' (H, W).
+    """
+    if frame is None:
+        frame = load_reference_frame()
+    if frame is None:
+        frame = synthetic_texture(shape)
+
+    cases = []
+    for kind in fields:
+        field = displacement_field(frame.shape, kind, magnitude)
+        warped, valid = warp_frame(frame, field)
+        valid[:margin] = valid[-margin:] = False
+        valid[:, :margin] = valid[:, -margin:] = False
+        cases.append({'field': kind, 'f1': frame, 'f2': warped, 'flow': field, 'valid': valid})
+    return cases
+
+def config_grid(process_options : dict = None, flow_options : dict = None) -> list:
+    """
+    Builds every combination of preprocessing variants and optical flow parameter values.
+
+    Args:
+        process_options (dict, optional): {name: preprocessing args}. Default is {'default': default_process}.
+        flow_options (dict, optional): {flow parameter: list of values}, the other parameters are taken
+            from default_flow. Default varies winsize, levels and iterations.
+
+    Returns:
+        list[dict]: Configurations with 'name', 'process' and 'flow'.
+    """
+    process_options = process_options or {'default': default_process}
+    flow_options = flow_options or {'winsize': [9, 15, 21], 'levels': [1, 3], 'iterations': [1, 3]}
+    keys = list(flow_options)
+    configs = []
+    for pname, process_args in process_options.items():
+        for values in itertools.product(*(flow_options[k] for k in keys)):
+            flow_args = {**default_flow, **dict(zip(keys, values))}
+            name = ' '.join([pname] + [f"{k}={v}" for k, v in zip(keys, values)])
+            configs.append({'name': name, 'process': process_args, 'flow': flow_args})
+    return configs
+
+def endpoint_error(estimate : np.ndarray, truth : np.ndarray, valid : np.ndarray = None) -> np.ndarray:
+    """
+    Endpoint error |estimate - truth| of every (valid) pixel.
+
+    Returns:
+        np.ndarray: Errors in pixels, flattened.
+    """
+    error = np.hypot(estimate[..., 0] - truth[..., 0], estimate[..., 1] - truth[..., 1])
+    return error[valid] if valid is not None else error.ravel()
+
+def evaluate_config(args) -> dict:
+    """
+    Runs one configuration on every case, timing preprocessing + flow.
+
+    Args:
+        args (tuple): (config, cases, repeats), see config_grid and make_cases. Every pair is timed
+            `repeats` times and the fastest run is kept, which filters out interference from the
+            other workers.
+
+    Returns:
+        dict: The configuration's 'name', 'process' and 'flow', its endpoint errors ('epe_mean',
+        'epe_median', 'epe_p95', and 'epe_<field>' per case) and throughput ('seconds' per pair,
+        'pairs_per_s', 'mpix_per_s').
+    """
+    config, cases, repeats = args
+    errors, seconds, pixels = [], 0.0, 0
+    result = {'name': config['name'], 'process': config['process'], 'flow': config['flow']}
+    for case in cases:
+        best = np.inf
+        for _ in range(repeats):
+            start = time.perf_counter()
+            p1 = preprocess_frame((case['f1'], config['process']))
+            p2 = preprocess_frame((case['f2'], config['process']))
+            estimate = compute_flow_pair((p1, p2, config['flow']))
+            best = min(best, time.perf_counter() - start)
+        seconds += best
+        pixels += case['f1'].size
+        error = endpoint_error(estimate, case['flow'], case['valid'])
+        result[f"epe_{case['field']}"] = float(error.mean())
+        errors.append(error)
+
+    errors = np.concatenate(errors)
+    result.update({'epe_mean': float(errors.mean()), 'epe_median': float(np.median(errors)),
+                   'epe_p95': float(np.quantile(errors, 0.95)), 'seconds': seconds / len(cases),
+                   'pairs_per_s': len(cases) / seconds, 'mpix_per_s': pixels / seconds / 1e6})
+    return result
+
+def pareto_front(results : list, error : str = 'epe_mean', cost : str = 'seconds') -> list:
+    """
+    Marks the results no other result beats in both error and cost (result['pareto'] = True).
+
+    Args:
+        results (list[dict]): Results of evaluate_config.
+        error (str): Error key to minimize. Default is 'epe_mean'.
+        cost (str): Cost key to minimize. Default is 'seconds'.
+
+    Returns:
+        list[dict]: The results sorted by cost, with 'pareto' set on each of them.
+    """
+    results = sorted(results, key=lambda r: (r[cost], r[error]))
+    best = np.inf
+    for r in results:
+        r['pareto'] = r[error] < best
+        best = min(best, r[error])
+    return results
+
+def print_table(results : list, error : str = 'epe_mean') -> None:
+    """
+    Prints results (from pareto_front) as a table, the Pareto-optimal ones marked with '*'.
+    """
+    width = max([len(r['name']) for r in results] + [6])
+    print(f"  {'config':<{width}} {'EPE':>7} {'EPE p95':>8} {'ms/pair':>8} {'pairs/s':>8} {'MPix/s':>7}")
+    for r in results:
+        mark = '*' if r.get('pareto') else ' '
+        print(f"{mark} {r['name']:<{width}} {r[error]:>7.3f} {r['epe_p95']:>8.3f} {1000 * r['seconds']:>8.1f} "
+              f"{r['pairs_per_s']:>8.1f} {r['mpix_per_s']:>7.2f}")
+
+def evaluate(configs : list = None, cases : list = None, repeats : int = 3, label : str = 'synthetic',
+             governor : ResourceGovernor = None, verbose : bool = True, save : bool = True) -> list:
+    """
+    Compares preprocessing/optical flow configurations on frames warped by known displacements.
+
+    Every configuration is run on every case (see make_cases) by the governor's workers, and its
+    endpoint error (distance between the estimated and the true flow vector, in pixels) is reported
+    next to its throughput. The results on the Pareto front, i.e. those no other configuration beats
+    in both error and time, are the sensible choices; pick one and store it with use_config.
+
+    Timings are taken inside the workers, each limited to its share of the threads, so compare them
+    between configurations of one run rather than with a full pipeline run.
+
+    Args:
+        configs (list[dict], optional): Configurations (see config_grid). Default is config_grid().
+        cases (list[dict], optional): Evaluation cases (see make_cases). Default is make_cases().
+        repeats (int): Timing repeats per pair, the fastest is kept. Default is 3.
+        label (str): Name of the report, e.g. the cell type the frames come from. Default is 'synthetic'.
+        governor (ResourceGovernor, optional): Memory/worker budget. Default is a new governor.
+        verbose (bool): Print the table. Default is True.
+        save (bool): Save the results as CellFlow/reports/evaluate/<label>_ei.json. Default is True.
+
+    Returns:
+        list[dict]: Results of evaluate_config, sorted by time, with 'pareto' set.
+    """
+    configs = configs or config_grid()
+    cases = cases or make_cases()
+    governor = governor or ResourceGovernor()
+    case_bytes = sum(4 * frame_bytes(c['f1'].shape, np.float32) + frame_bytes(c['flow'].shape, np.float32) for c in cases)
+    _, workers = governor.plan('evaluate', len(configs), case_bytes)
+
+    with governor.executor(workers) as ex:
+        results = ex.map(evaluate_config, [(config, cases, repeats) for config in configs])
+    results = pareto_front(results)
+
+    if verbose:
+        print_table(results)
+    if save:
+        report_path = mem.get_unique_path('reports', 'evaluate', lambda i: f"{label}_e{i}.json")
+        with open(report_path, 'w') as f:
+            json.dump({'label': label, 'fields': [c['field'] for c in cases], 'results': results}, f, indent=2)
+    return results
+
+def use_config(stacktype : str, result : dict) -> None:
+    """
+    Makes a configuration the production setting of a cell type (its 'preprocess' and 'optical_flow' in types.json).
+
+    Args:
+        stacktype (str): Cell type.
+        result (dict): Result (or configuration) with 'process' and 'flow'.
+
+    Returns:
+        None
+    """
+    params = mem.load_params(stacktype)
+    params['preprocess'] = result['process']
+    params['optical_flow'] = result['flow']
+    mem.save_type(stacktype, params)
@@ -1,7 +1,10 @@
 import cv2
 import numpy as np
 from scipy.ndimage import gaussian_laplace
-from multiprocessing import Pool, cpu_count
+from contextlib import nullcontext
+from src.governor import ResourceGovernor, frame_bytes
+from src.mask import mask_boxes
+from src.sparseflow import SparseFlow
 
 def preprocess_frame(args) -> np.ndarray:
     """
@@ -56,23 +59,79 @@ def preprocess_frame(args) -> np.ndarray:
 
     return frame
 
-def preprocess_stack(arr: np.ndarray, **kwargs) -> np.ndarray:
+def preprocess_frame_bytes(shape : tuple, dtype) -> int:
+    """
+    Rough peak memory of one preprocess_frame call: the frame sent to the worker, the blurred
+    intermediates and the returned frame, plus a float64 plane for the Laplace filter.
+
+    Args:
+        shape (tuple): Frame shape (H, W).
+        dtype (np.dtype): Frame data type.
+
+    Returns:
+        int: Estimated number of bytes.
+    """
+    return 4 * frame_bytes(shape, dtype) + frame_bytes(shape, np.float64)
+
+def flow_pair_bytes(shape : tuple, dtype) -> int:
+    """
+    Rough peak memory of one compute_flow_pair call: both input frames, the float32 output and
+    Farneback's polynomial expansion buffers (about 14 float32 planes across the pyramid).
+
+    Args:
+        shape (tuple): Frame shape (H, W).
+        dtype (np.dtype): Frame data type.
+
+    Returns:
+        int: Estimated number of bytes.
+    """
+    h, w = shape[:2]
+    return 2 * frame_bytes((h, w), dtype) + frame_bytes((h, w, 2), np.float32) + frame_bytes((h, w, 14), np.float32)
+
+def _use_pool(governor : ResourceGovernor, workers : int, pool=None):
+    """
+    Returns a context manager yielding `pool` if given, otherwise a new executor of `workers`
+    workers with the governor's backend.
+    """
+    return nullcontext(pool) if pool is not None else governor.executor(workers)
+
+def preprocess_stack(arr: np.ndarray, governor : ResourceGovernor = None, pool=None, fixed_bytes : int = 0, **kwargs) -> np.ndarray:
     """
     Preprocesses a stack of frames with optional Gaussian/median blurs, normalization,
     and type conversion.
 
+    Frames are handed to the workers in chunks sized by the governor, and written into a
+    preallocated output, so only one chunk of intermediate results exists at a time.
+
     Args:
         arr (np.ndarray): Input stack of frames (shape: N x H x W).
+        governor (ResourceGovernor, optional): Decides chunk size and worker count. Default is a new governor.
+        pool (Executor, optional): Existing executor (or multiprocessing.Pool) to use. The caller is then responsible for
+            sizing arr to the memory budget, and the whole stack is mapped at once. Default is None.
+        fixed_bytes (int): Memory the caller already holds (e.g. the stack itself), which the chunks
+            have to fit beside. Default is 0.
         **kwargs: Dictionary with preprocessing parameters (see preprocess_frame).
 
     Returns:
         np.ndarray: Preprocessed stack of frames.
     """
+    n = arr.shape[0]
+    if pool is not None:
+        chunk_size, workers = n, None
+    else:
+        governor = governor or ResourceGovernor()
+        chunk_size, workers = governor.plan('preprocess', n, preprocess_frame_bytes(arr.shape[1:], arr.dtype), fixed_bytes=fixed_bytes)
 
-    frames = [(arr[i], kwargs) for i in range(arr.shape[0])]
-    with Pool(cpu_count()) as pool:
-        preprocessed_frames = pool.map(preprocess_frame, frames)
-    return np.stack(preprocessed_frames, axis=0)
+    out = None
+    with _use_pool(governor, workers, pool) as p:
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            frames = [(arr[i], kwargs) for i in range(start, stop)]
+            processed = p.map(preprocess_frame, frames)
+            if out is None:
+                out = np.empty((n,) + processed[0].shape, dtype=processed[0].dtype)
+            out[start:stop] = processed
+    return out
 
 def combine_flows(flow_list : list) -> np.ndarray:
     """
@@ -126,7 +185,9 @@ def optical_flow(   arr : np.array,
                     iterations : int = 3, 
                     poly_n : int = 5, 
                     poly_sigma : float = 1.2,
-                    flag : int = 0) -> np.ndarray:
+                    flag : int = 0,
+                    governor : ResourceGovernor = None,
+                    pool=None) -> np.ndarray:
     """
     Computes dense optical flow using Farneback method on a preprocessed channel. Allows manual
     changes to the params for optical flow.
@@ -140,7 +201,9 @@ def optical_flow(   arr : np.array,
             - poly_n: int, size of the pixel neighborhood
             - poly_sigma: float, standard deviation of the Gaussian used for polynomial expansion
             - flags: int, operation flags
-            - **kwargs: dict with keys for preprocessing (see preprocess_frame)
+            - governor: ResourceGovernor, decides chunk size and worker count (default is a new governor)
+            - pool: Executor (or multiprocessing.Pool), existing pool to use. The caller is then responsible for
+                sizing arr to the memory budget, and all pairs are mapped at once.
                 
     Returns:
         np.ndarray: (N-1, H, W, 2) flow vectors between frames.
@@ -155,7 +218,188 @@ def optical_flow(   arr : np.array,
         'poly_sigma': poly_sigma,
         'flag': flag
     }
-    pairs = [(arr[i], arr[i+1], flow_args) for i in range(arr.shape[0] - 1)]
-    with Pool(cpu_count()) as pool:
-        flow_list = pool.map(compute_flow_pair, pairs)
-    return np.stack(flow_list)
\ No newline at end of file
+    n_pairs = arr.shape[0] - 1
+    if pool is not None:
+        chunk_size, workers = n_pairs, None
+    else:
+        governor = governor or ResourceGovernor()
+        chunk_size, workers = governor.plan('optical flow', n_pairs, flow_pair_bytes(arr.shape[1:], arr.dtype))
+
+    out = np.empty((n_pairs,) + arr.shape[1:3] + (2,), dtype=np.float32)
+    with _use_pool(governor, workers, pool) as p:
+        for start in range(0, n_pairs, chunk_size):
+            stop = min(start + chunk_size, n_pairs)
+            pairs = [(arr[i], arr[i+1], flow_args) for i in range(start, stop)]
+            out[start:stop] = p.map(compute_flow_pair, pairs)
+    return out
+
+def compute_masked_flow_pair(args) -> np.ndarray:
+    """
+    Computes Farneback optical flow for a pair of frames, only inside the tiles covering a mask.
+
+    Flow is computed separately on every padded box returned by mask.mask_boxes and only the
+    core of each box is kept, so the background between cells is never processed.
+
+    Args:
+        args (tuple): A tuple containing two frames, a mask and flow arguments.
+            - f1: First frame (np.ndarray).
+            - f2: Second frame (np.ndarray).
+            - mask: Boolean mask (np.ndarray) of the pixels to keep.
+            - flow_args: Dictionary with parameters for optical flow calculation (see compute_flow_pair).
+            - tile: int, tile size in pixels.
+            - pad: int, context margin around every box in pixels.
+
+    Returns:
+        np.ndarray: Array of shape (k, 2) with the flow at np.flatnonzero(mask).
+    """
+    f1, f2, mask, flow_args, tile, pad = args
+    field = np.zeros(f1.shape[:2] + (2,), dtype=np.float32)
+    for (cy0, cy1, cx0, cx1), (py0, py1, px0, px1) in mask_boxes(mask, tile, pad):
+        box_flow = compute_flow_pair((f1[py0:py1, px0:px1], f2[py0:py1, px0:px1], flow_args))
+        field[cy0:cy1, cx0:cx1] = box_flow[cy0 - py0:cy1 - py0, cx0 - px0:cx1 - px0]
+    return field[mask]
+
+def masked_optical_flow(arr : np.ndarray, masks : np.ndarray, flow_args : dict,
+                        tile : int = 64, pad : int = 32,
+                        governor : ResourceGovernor = None, pool=None, fixed_bytes : int = 0) -> SparseFlow:
+    """
+    Computes optical flow restricted to cell masks and returns it in sparse form.
+
+    The flow between frames i and i+1 is kept wherever either frame's mask is set.
+
+    Args:
+        arr (np.ndarray): Preprocessed stack (N, H, W).
+        masks (np.ndarray): Boolean masks (N, H, W), see mask.mask_stack.
+        flow_args (dict): Parameters for optical flow calculation (see compute_flow_pair).
+        tile (int): Tile size in pixels. Default is 64.
+        pad (int): Context margin around every box in pixels. Default is 32.
+        governor (ResourceGovernor, optional): Decides chunk size and worker count. Default is a new governor.
+        pool (Executor, optional): Existing executor (or multiprocessing.Pool) to use for all pairs. Default is None.
+        fixed_bytes (int): Memory the caller already holds (e.g. the stacks and masks), which the chunks
+            have to fit beside. Default is 0.
+
+    Returns:
+        SparseFlow: Single-channel sparse flow with N-1 frames.
+    """
+    n_pairs = arr.shape[0] - 1
+    pair_masks = masks[:-1] | masks[1:]
+    if pool is not None:
+        chunk_size, workers = n_pairs, None
+    else:
+        governor = governor or ResourceGovernor()
+        chunk_size, workers = governor.plan('masked optical flow', n_pairs, flow_pair_bytes(arr.shape[1:], arr.dtype),
+                                          fixed_bytes=fixed_bytes)
+
+    values = []
+    with _use_pool(governor, workers, pool) as p:
+        for start in range(0, n_pairs, chunk_size):
+            stop = min(start + chunk_size, n_pairs)
+            pairs = [(arr[i], arr[i+1], pair_masks[i], flow_args, tile, pad) for i in range(start, stop)]
+            values.extend(p.map(compute_masked_flow_pair, pairs))
+    return SparseFlow.from_masks(pair_masks, values)
+
+def lag_starts(n_frames : int, lag : int, stride : int = 1) -> range:
+    """
+    Returns the first frames of the pairs (i, i + lag) used for one lag.
+
+    Args:
+        n_frames (int): Number of frames in the stack.
+        lag (int): Distance between the frames of a pair.
+        stride (int): Distance between consecutive pairs. Default is 1.
+
+    Returns:
+        range: Start frame of every pair.
+    """
+    return range(0, n_frames - lag, stride)
+
+def multi_lag_flow(arr, lags : list = (1, 2, 4, 8), stride : int = 1, flow_args : dict = None,
+                   governor : ResourceGovernor = None, pool=None, out : dict = None, writer=None,
+                   fixed_bytes : int = 0) -> dict:
+    """
+    Computes optical flow for several frame lags in one scheduled job.
+
+    The stack is expected to be preprocessed already, so every frame is preprocessed once no
+    matter how many lags use it. The pairs of all lags are mapped together, in governor-sized
+    chunks, so the workers stay busy across lags. Every chunk is written into `out` as soon as it
+    is done, so with memory-mapped outputs (see memory.open_multi_lag_flow) only one chunk of flows
+    is ever held in memory.
+
+    Args:
+        arr (np.ndarray | list[np.ndarray]): Preprocessed stack (N, H, W), or one such stack per
+            channel. For several channels every pair is computed on each of them and the results
+            are combined with combine_flows.
+        lags (list[int]): Lags to compute, e.g. [1, 2, 4, 8]. Default is (1, 2, 4, 8).
+        stride (int): Distance between the start frames of consecutive pairs (see lag_starts). Default is 1.
+        flow_args (dict, optional): Parameters for optical flow calculation (see compute_flow_pair).
+            Default is defaults.default_flow.
+        governor (ResourceGovernor, optional): Decides chunk size and worker count. Default is a new governor.
+        pool (Executor, optional): Existing executor (or multiprocessing.Pool) to use for all pairs. Default is None.
+        out (dict, optional): {lag: array} to write into, with the shapes given by multi_lag_shapes.
+            Default is None (allocated in memory, which the governor accounts for).
+        writer (AsyncWriter, optional): Writes the chunks into `out` in the background. Default is None.
+        fixed_bytes (int): Memory the caller already holds (e.g. the preprocessed stacks), which the
+            chunks have to fit beside. Default is 0.
+
+    Returns:
+        dict: {lag: array of shape (len(lag_starts(N, lag, stride)), H, W, 2)}, or (..., C + 1, H, W, 2)
+        for several channels.
+    """
+    if flow_args is None:
+        from src.defaults import default_flow
+        flow_args = default_flow
+    stacks = list(arr) if isinstance(arr, (list, tuple)) else [arr]
+    n, h, w = stacks[0].shape[:3]
+    shapes = multi_lag_shapes(n, (h, w), lags, stride, len(stacks))
+    lags = list(shapes)
+
+    jobs = [(lag, j, i) for lag in lags for j, i in enumerate(lag_starts(n, lag, stride))]
+    pair_bytes = len(stacks) * flow_pair_bytes((h, w), stacks[0].dtype) + frame_bytes(shapes[lags[0]][1:], np.float32) if lags else 1
+    if pool is not None:
+        chunk_size, workers = max(len(jobs), 1), None
+    else:
+        governor = governor or ResourceGovernor()
+        if out is None:
+            fixed_bytes += sum(frame_bytes(shape, np.float32) for shape in shapes.values())
+        elif writer is not None:
+            fixed_bytes += governor.max_memory // 2 # room for the chunks queued in the writer
+        chunk_size, workers = governor.plan('multi-lag flow', len(jobs), pair_bytes, fixed_bytes=fixed_bytes)
+    if out is None:
+        out = {lag: np.empty(shape, dtype=np.float32) for lag, shape in shapes.items()}
+
+    with _use_pool(governor, workers, pool) as p:
+        for start in range(0, len(jobs), chunk_size):
+            chunk = jobs[start:start + chunk_size]
+            nbytes = len(chunk) * pair_bytes
+            with (governor.reserve(nbytes, writer) if governor is not None else nullcontext()):
+                flows = [np.asarray(p.map(compute_flow_pair, [(stack[i], stack[i + lag], flow_args) for lag, _, i in chunk]))
+                         for stack in stacks]
+                flows = combine_flows(flows) if len(stacks) > 1 else flows[0]
+                # jobs are ordered by lag, so a chunk holds one contiguous block per lag
+                for lag in sorted(set(lag for lag, _, _ in chunk)):
+                    idx = [k for k, (l, _, _) in enumerate(chunk) if l == lag]
+                    first = chunk[idx[0]][1]
+                    block = flows[idx[0]:idx[-1] + 1]
+                    if writer is not None:
+                        writer.write_chunk(out[lag], first, block)
+                    else:
+                        out[lag][first:first + len(block)] = block
+                del flows
+    return out
+
+def multi_lag_shapes(n_frames : int, frame_shape : tuple, lags : list, stride : int = 1, n_channels : int = 1) -> dict:
+    """
+    Returns the output shape of multi_lag_flow for every usable lag (0 < lag < n_frames).
+
+    Args:
+        n_frames (int): Number of frames in the stack.
+        frame_shape (tuple): (H, W).
+        lags (list[int]): Requested lags.
+        stride (int): Distance between the start frames of consecutive pairs. Default is 1.
+        n_channels (int): Number of preprocessed stacks; several are combined to C + 1 channels. Default is 1.
+
+    Returns:
+        dict: {lag: shape}, sorted by lag.
+    """
+    channels = (n_channels + 1,) if n_channels > 1 else ()
+    lags = sorted(set(int(lag) for lag in lags if 0 < lag < n_frames))
+    return {lag: (len(lag_starts(n_frames, lag, stride)),) + channels + tuple(frame_shape[:2]) + (2,) for lag in lags}
\ No newline at end of file
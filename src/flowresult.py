@@ -0,0 +1,178 @@
+import numpy as np
+from pathlib import Path
+from collections import OrderedDict
+
+class FlowResult():
+    def __init__(self, source, cache_bytes : int = 512 * 1024**2):
+        """
+        Lazy handle to an optical flow, stored on disk or in memory.
+
+        A path is opened memory-mapped, so slicing by frame, channel or ROI only reads what is asked
+        for. Magnitudes, angles and channel sums are computed on demand and kept in an LRU cache of at
+        most `cache_bytes`, so repeated analysis of the same frames doesn't recompute or copy them.
+        Indexing (result[...]) and np.asarray(result) behave like the underlying array.
+
+        Args:
+            source (str | Path | np.ndarray): Path to a flow .npy file, or a flow array of shape
+                (T, C, H, W, 2) or (T, H, W, 2).
+            cache_bytes (int): Maximum size of the cache of derived quantities. Default is 512 MB.
+
+        Attributes:
+            path (Path): Path of the flow file, None for in-memory flows.
+            cache_bytes (int): Maximum size of the cache.
+        """
+        if isinstance(source, (str, Path)):
+            self.path = Path(source)
+            self._arr = np.load(self.path, mmap_mode='r')
+        else:
+            filename = getattr(source, 'filename', None)
+            self.path = Path(filename) if filename else None
+            self._arr = source
+        self.cache_bytes = cache_bytes
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    def __repr__(self) -> str:
+        source = self.path if self.path is not None else 'memory'
+        return f"FlowResult(shape={self.shape}, source={source})"
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __getitem__(self, key) -> np.ndarray:
+        return np.asarray(self._arr[key])
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._arr, dtype=dtype)
+
+    @property
+    def shape(self) -> tuple:
+        return self._arr.shape
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self._arr.dtype
+
+    @property
+    def ndim(self) -> int:
+        return self._arr.ndim
+
+    @property
+    def has_channels(self) -> bool:
+        """
+        True for combined flows of shape (T, C, H, W, 2).
+        """
+        return self._arr.ndim == 5
+
+    def view(self, channel : int = None) -> np.ndarray:
+        """
+        Returns the flow of one channel without reading it (a view of the memory map).
+
+        Args:
+            channel (int, optional): Channel to select. Ignored for flows without channels.
+
+        Returns:
+            np.ndarray: Array (or np.memmap) of shape (T, H, W, 2).
+        """
+        if self.has_channels and channel is not None:
+            return self._arr[:, channel]
+        return self._arr
+
+    def _key(self, frames, roi) -> tuple:
+        if isinstance(frames, slice):
+            frames = frames.indices(self.shape[0])
+        elif np.ndim(frames) == 0:
+            frames = int(frames)
+        else:
+            frames = tuple(np.asarray(frames).tolist())
+        return frames, tuple(roi) if roi is not None else None
+
+    def select(self, frames=slice(None), channel : int = None, roi : tuple = None) -> np.ndarray:
+        """
+        Reads a part of the flow.
+
+        Args:
+            frames (int | slice | list[int]): Frames to read. Default is all frames.
+            channel (int, optional): Channel to read. Default is None (all channels).
+            roi (tuple, optional): (y0, y1, x0, x1) region to read. Default is the whole frame.
+
+        Returns:
+            np.ndarray: The selected flow, (..., H, W, 2) with H, W cropped to the ROI.
+        """
+        arr = self.view(channel)[frames]
+        if roi is not None:
+            y0, y1, x0, x1 = roi
+            arr = arr[..., y0:y1, x0:x1, :]
+        return np.asarray(arr)
+
+    def _cached(self, key : tuple, compute) -> np.ndarray:
+        """
+        Returns the cached value for key, computing and caching it (LRU, bounded by cache_bytes) if missing.
+        """
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+
+        value = compute()
+        value.flags.writeable = False # shared between callers
+        if value.nbytes <= self.cache_bytes:
+            self._cache[key] = value
+            self._cached_bytes += value.nbytes
+            while self._cached_bytes > self.cache_bytes:
+                _, old = self._cache.popitem(last=False)
+                self._cached_bytes -= old.nbytes
+        return value
+
+    def magnitude(self, frames=slice(None), channel : int = 0, roi : tuple = None) -> np.ndarray:
+        """
+        Speed sqrt(dx^2 + dy^2) of a part of the flow (see select), cached.
+
+        Returns:
+            np.ndarray: Array of the selected shape without the last axis.
+        """
+        key = ('magnitude', channel) + self._key(frames, roi)
+        def compute():
+            f = self.select(frames, channel, roi)
+            return np.hypot(f[..., 0], f[..., 1])
+        return self._cached(key, compute)
+
+    def angle(self, frames=slice(None), channel : int = 0, roi : tuple = None) -> np.ndarray:
+        """
+        Direction arctan2(dy, dx) in radians of a part of the flow (see select), cached.
+
+        Returns:
+            np.ndarray: Array of the selected shape without the last axis.
+        """
+        key = ('angle', channel) + self._key(frames, roi)
+        def compute():
+            f = self.select(frames, channel, roi)
+            return np.arctan2(f[..., 1], f[..., 0])
+        return self._cached(key, compute)
+
+    def channel_sum(self, frames=slice(None), channels : tuple = (1, 2), roi : tuple = None) -> np.ndarray:
+        """
+        Sum of the flows of several channels (see select), cached.
+
+        Args:
+            frames (int | slice | list[int]): Frames to read. Default is all frames.
+            channels (tuple[int]): Channels to add. Default is (1, 2), the two computed channels.
+            roi (tuple, optional): (y0, y1, x0, x1) region to read. Default is the whole frame.
+
+        Returns:
+            np.ndarray: Summed flow, (..., H, W, 2).
+        """
+        assert self.has_channels, "channel_sum needs a flow of shape (T, C, H, W, 2)"
+        key = ('channel_sum', tuple(channels)) + self._key(frames, roi)
+        def compute():
+            total = self.select(frames, channels[0], roi).astype(np.float32)
+            for c in channels[1:]:
+                total += self.select(frames, c, roi)
+            return total
+        return self._cached(key, compute)
+
+    def clear_cache(self) -> None:
+        """
+        Drops every cached quantity.
+        """
+        self._cache.clear()
+        self._cached_bytes = 0
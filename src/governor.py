@@ -0,0 +1,197 @@
+import os
+import threading
+from contextlib import contextmanager
+import numpy as np
+from multiprocessing import cpu_count
+from src.backend import Executor
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+FALLBACK_MEMORY = 4 * 1024**3 # used when available memory can't be detected
+
+def available_memory() -> int:
+    """
+    Returns the amount of memory currently available to the process, in bytes.
+
+    Uses psutil if it is installed, otherwise falls back to sysconf (Linux/MacOS). If neither
+    works (e.g. Windows without psutil), FALLBACK_MEMORY is returned.
+
+    Returns:
+        int: Available memory in bytes.
+    """
+    if psutil is not None:
+        return int(psutil.virtual_memory().available)
+    try:
+        return os.sysconf('SC_AVPHYS_PAGES') * os.sysconf('SC_PAGE_SIZE')
+    except (ValueError, OSError, AttributeError):
+        return FALLBACK_MEMORY
+
+def frame_bytes(shape : tuple, dtype) -> int:
+    """
+    Returns the size in bytes of a single frame.
+
+    Args:
+        shape (tuple): Shape of the frame, e.g. (H, W) or (H, W, 2).
+        dtype (np.dtype): Data type of the frame.
+
+    Returns:
+        int: Number of bytes.
+    """
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+def format_bytes(n : int) -> str:
+    return f"{n / 1024**2:.1f} MB"
+
+class ResourceGovernor():
+    def __init__(self, max_memory : int = None, max_workers : int = None, backend : str = 'process', verbose : bool = True):
+        """
+        Decides how much work each pipeline stage may have in flight at once.
+
+        Every stage (loading, preprocessing, flow, trajectory, rendering) asks the governor for a
+        plan before it starts. The plan is a chunk size (number of frames/pairs held in memory at
+        once) and a worker count, derived from the per-item cost the stage reports. Stages that
+        hand work to other threads (e.g. an AsyncWriter) can also `acquire`/`release` bytes, in
+        which case the producer blocks until memory is freed instead of running out of it.
+
+        Args:
+            max_memory (int, optional): Memory budget in bytes. Default is half the memory currently available.
+            max_workers (int, optional): Maximum number of worker processes/threads. Default is cpu_count().
+            backend (str): Execution backend for the workers, 'thread', 'process' or 'serial' (see
+                backend.Executor and backend.benchmark_backends). Default is 'process'.
+            verbose (bool): Print every plan that is made. Default is True.
+
+        Attributes:
+            max_memory (int): Memory budget in bytes.
+            max_workers (int): Maximum number of workers.
+            backend (str): Execution backend.
+            history (list[dict]): Every plan made by this governor, in order.
+        """
+        self.max_memory = int(max_memory) if max_memory is not None else available_memory() // 2
+        self.max_workers = max_workers if max_workers is not None else cpu_count()
+        self.backend = backend
+        self.verbose = verbose
+        self.history = []
+        self._in_use = 0
+        self._cond = threading.Condition()
+
+    def log(self, message : str) -> None:
+        if self.verbose:
+            print(f"[INFO] {message}")
+
+    def fits(self, nbytes : int) -> bool:
+        """
+        Checks whether an allocation of `nbytes` fits into the memory budget.
+
+        Args:
+            nbytes (int): Size of the allocation.
+
+        Returns:
+            bool: True if it fits.
+        """
+        return nbytes <= self.max_memory
+
+    def plan(self, stage : str, n_items : int, item_bytes : int, fixed_bytes : int = 0) -> tuple:
+        """
+        Chooses a chunk size and worker count for a stage.
+
+        Args:
+            stage (str): Name of the stage, used for logging.
+            n_items (int): Total number of items (frames, pairs, ...) the stage will process.
+            item_bytes (int): Estimated peak memory needed per item while it is processed.
+            fixed_bytes (int): Memory the stage needs regardless of chunking (e.g. its output). Default is 0.
+
+        Returns:
+            tuple: (chunk_size, workers).
+        """
+        n_items = max(int(n_items), 1)
+        item_bytes = max(int(item_bytes), 1)
+        budget = self.max_memory - fixed_bytes
+        chunk_size = int(min(max(budget // item_bytes, 1), n_items))
+        workers = 1 if self.backend == 'serial' else int(max(min(self.max_workers, chunk_size), 1))
+
+        if budget < item_bytes:
+            self.log(f"{stage}: a single item (~{format_bytes(item_bytes)}) exceeds the remaining "
+                     f"budget ({format_bytes(budget)}), processing one at a time")
+
+        self.history.append({'stage': stage, 'n_items': n_items, 'item_bytes': item_bytes,
+                             'fixed_bytes': fixed_bytes, 'chunk_size': chunk_size, 'workers': workers})
+        self.log(f"{stage}: {n_items} items of ~{format_bytes(item_bytes)}, chunk size {chunk_size}, "
+                 f"{workers} {self.backend} workers (budget {format_bytes(self.max_memory)})")
+        return chunk_size, workers
+
+    def executor(self, workers : int) -> Executor:
+        """
+        Creates an executor of the governor's backend. The machine's threads are split between the
+        workers, so OpenCV (and BLAS, if threadpoolctl is installed) inside each worker don't
+        oversubscribe it.
+
+        Args:
+            workers (int): Number of workers, usually from `plan`.
+
+        Returns:
+            Executor: Executor to use as a context manager.
+        """
+        return Executor(self.backend, workers, total_threads=self.max_workers)
+
+    def acquire(self, nbytes : int) -> None:
+        """
+        Reserves `nbytes` of the budget, blocking until enough has been released.
+
+        A reservation larger than the whole budget is still granted once nothing else is held,
+        so an oversized item slows the pipeline down instead of deadlocking it.
+
+        Args:
+            nbytes (int): Number of bytes to reserve.
+
+        Returns:
+            None
+        """
+        with self._cond:
+            while self._in_use > 0 and self._in_use + nbytes > self.max_memory:
+                self._cond.wait()
+            self._in_use += nbytes
+
+    def release(self, nbytes : int) -> None:
+        """
+        Returns `nbytes` previously reserved with `acquire`.
+
+        Args:
+            nbytes (int): Number of bytes to release.
+
+        Returns:
+            None
+        """
+        with self._cond:
+            self._in_use = max(self._in_use - nbytes, 0)
+            self._cond.notify_all()
+
+    @contextmanager
+    def reserve(self, nbytes : int, writer=None):
+        """
+        Holds `nbytes` of the budget (see acquire) for the duration of a `with` block.
+
+        Without a writer the bytes are released when the block ends. With a writer they are released
+        by a job queued behind the block's writes, so they stay reserved until the data is on disk.
+        If the block raises, the bytes are released right away, so a failed chunk never leaks budget.
+
+        Args:
+            nbytes (int): Number of bytes to reserve.
+            writer (AsyncWriter, optional): Writer the block hands its output to. Default is None.
+        """
+        self.acquire(nbytes)
+        try:
+            yield
+        except BaseException:
+            self.release(nbytes)
+            raise
+        if writer is None:
+            self.release(nbytes)
+        else:
+            try:
+                writer.submit(self.release, nbytes)
+            except BaseException:
+                self.release(nbytes)
+                raise
@@ -0,0 +1,124 @@
+import cv2
+import numpy as np
+from contextlib import nullcontext
+from src.governor import ResourceGovernor, frame_bytes
+
+def cell_mask(frame : np.ndarray, **kwargs) -> np.ndarray:
+    """
+    Derives a binary cell mask from a (preprocessed) frame by thresholding and morphology.
+
+    Args:
+        frame (np.ndarray): Input frame (H, W).
+        **kwargs: Dictionary with mask parameters:
+            - thresh (int): fixed threshold on the 0-255 normalized frame. Default is None (Otsu).
+            - open (int): kernel size of the opening that removes speckles. Default is 5.
+            - close (int): kernel size of the closing that fills holes. Default is 9.
+            - min_area (int): connected components smaller than this are dropped. Default is 64.
+            - dilate (int): kernel size of the final dilation, a safety margin around cells. Default is 15.
+
+    Returns:
+        np.ndarray: Boolean mask (H, W).
+    """
+    if frame.dtype != np.uint8:
+        frame = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+    thresh = kwargs.get('thresh', None)
+    if thresh is None:
+        _, mask = cv2.threshold(frame, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    else:
+        _, mask = cv2.threshold(frame, thresh, 255, cv2.THRESH_BINARY)
+
+    for op, key, default in [(cv2.MORPH_OPEN, 'open', 5), (cv2.MORPH_CLOSE, 'close', 9)]:
+        ksize = kwargs.get(key, default)
+        if ksize:
+            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (ksize, ksize))
+            mask = cv2.morphologyEx(mask, op, kernel)
+
+    min_area = kwargs.get('min_area', 64)
+    if min_area:
+        n, labels, stats, _ = cv2.connectedComponentsWithStats(mask, connectivity=8)
+        keep = stats[:, cv2.CC_STAT_AREA] >= min_area
+        keep[0] = False # background
+        mask = keep[labels].astype(np.uint8) * 255
+
+    dilate = kwargs.get('dilate', 15)
+    if dilate:
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (dilate, dilate))
+        mask = cv2.dilate(mask, kernel)
+
+    return mask > 0
+
+def mask_frame(args) -> np.ndarray:
+    """
+    Pool-friendly wrapper around cell_mask.
+
+    Args:
+        args (tuple): (frame, kwargs), see cell_mask.
+
+    Returns:
+        np.ndarray: Boolean mask (H, W).
+    """
+    frame, kwargs = args
+    return cell_mask(frame, **kwargs)
+
+def mask_stack(arr : np.ndarray, governor : ResourceGovernor = None, pool=None, fixed_bytes : int = 0, **kwargs) -> np.ndarray:
+    """
+    Derives cell masks for every frame of a stack.
+
+    Args:
+        arr (np.ndarray): Stack of (preprocessed) frames (N, H, W).
+        governor (ResourceGovernor, optional): Decides chunk size and worker count. Default is a new governor.
+        pool (Executor, optional): Existing executor (or multiprocessing.Pool) to use for the whole stack. Default is None.
+        fixed_bytes (int): Memory the caller already holds (e.g. the preprocessed stacks), which the
+            chunks have to fit beside. Default is 0.
+        **kwargs: Dictionary with mask parameters (see cell_mask).
+
+    Returns:
+        np.ndarray: Boolean masks (N, H, W).
+    """
+    n = arr.shape[0]
+    if pool is not None:
+        chunk_size, workers = n, None
+    else:
+        governor = governor or ResourceGovernor()
+        chunk_size, workers = governor.plan('masks', n, 4 * frame_bytes(arr.shape[1:], np.uint8) + frame_bytes(arr.shape[1:], arr.dtype),
+                                            fixed_bytes=fixed_bytes + frame_bytes(arr.shape, bool))
+
+    out = np.empty(arr.shape, dtype=bool)
+    with (nullcontext(pool) if pool is not None else governor.executor(workers)) as p:
+        for start in range(0, n, chunk_size):
+            stop = min(start + chunk_size, n)
+            out[start:stop] = p.map(mask_frame, [(arr[i], kwargs) for i in range(start, stop)])
+    return out
+
+def mask_boxes(mask : np.ndarray, tile : int = 64, pad : int = 32) -> list:
+    """
+    Covers a mask with rectangular boxes made of whole tiles.
+
+    The frame is split into a grid of tile x tile blocks. Blocks containing any mask pixel are
+    grouped into connected regions, and every region becomes one box (its bounding rectangle).
+    Each box is returned twice: the core that the region covers, and the core grown by `pad`
+    pixels, which is what flow should be computed on so window effects stay out of the core.
+
+    Args:
+        mask (np.ndarray): Boolean mask (H, W).
+        tile (int): Tile size in pixels. Default is 64.
+        pad (int): Context margin around every box in pixels. Default is 32.
+
+    Returns:
+        list[tuple]: ((y0, y1, x0, x1) core, (y0, y1, x0, x1) padded) per box.
+    """
+    h, w = mask.shape
+    gh, gw = -(-h // tile), -(-w // tile)
+    grid = np.zeros((gh * tile, gw * tile), dtype=bool)
+    grid[:h, :w] = mask
+    active = grid.reshape(gh, tile, gw, tile).any(axis=(1, 3)).astype(np.uint8)
+
+    n, _, stats, _ = cv2.connectedComponentsWithStats(active, connectivity=8)
+    boxes = []
+    for label in range(1, n):
+        x, y, bw, bh = stats[label, :4]
+        core = (y * tile, min((y + bh) * tile, h), x * tile, min((x + bw) * tile, w))
+        padded = (max(core[0] - pad, 0), min(core[1] + pad, h), max(core[2] - pad, 0), min(core[3] + pad, w))
+        boxes.append((core, padded))
+    return boxes
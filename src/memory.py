@@ -1,5 +1,6 @@
 import os
 import json
+import struct
 import numpy as np
 from pathlib import Path
 import matplotlib.animation as animation
@@ -33,7 +34,7 @@ def init_memory() -> None:
     except Exception as e:
         print(f"[ERROR] Failed to initialize memory: {e}")
 
-def get_unique_path(name, file_type, pattern_fn) -> Path:
+def get_unique_path(name, file_type, pattern_fn, aliases=()) -> Path:
     """
     Generates a unique file path in the given directory based on a naming pattern.
 
@@ -41,10 +42,27 @@ def get_unique_path(name, file_type, pattern_fn) -> Path:
         name (str): Main identifier (e.g., protein name).
         file_type (str): Subdirectory (e.g., 'flow', 'trajectory').
         pattern_fn (callable): Function that takes an integer and returns a file name.
+        aliases (tuple[str]): Other suffixes (e.g. '.npz') that also claim an index, so dense and
+            sparse versions of an artifact never share a tag. Default is ().
 
     Returns:
         Path: Unique file path that does not yet exist.
     """
+    return main_path / name / file_type / pattern_fn(get_unique_index(name, file_type, pattern_fn, aliases))
+
+def get_unique_index(name, file_type, pattern_fn, aliases=()) -> int:
+    """
+    Returns the first index whose file name (see get_unique_path) is still free, i.e. the tag of the next artifact.
+
+    Args:
+        name (str): Main identifier (e.g., protein name).
+        file_type (str): Subdirectory (e.g., 'flow', 'trajectory').
+        pattern_fn (callable): Function that takes an integer and returns a file name.
+        aliases (tuple[str]): Other suffixes that also claim an index (see get_unique_path). Default is ().
+
+    Returns:
+        int: Unused index.
+    """
     save_dir = main_path / name / file_type
     save_dir.mkdir(parents=True, exist_ok=True)
 
@@ -52,40 +70,208 @@ def get_unique_path(name, file_type, pattern_fn) -> Path:
     while True:
         file_name = pattern_fn(i)
         file_path = save_dir / file_name
-        if not file_path.exists():
-            return file_path
+        if not file_path.exists() and not any(file_path.with_suffix(s).exists() for s in aliases):
+            return i
         i += 1
-   
+
+def _write(file_path : Path, func, *args, writer=None) -> None:
+    """
+    Runs a write either immediately or through an AsyncWriter.
+
+    When a writer is given the path is reserved right away (by creating an empty file), so a
+    second save issued before the first one lands still gets its own unique name.
+
+    Args:
+        file_path (Path): Destination of the write.
+        func (callable): Function that performs the write, called as func(*args).
+        writer (AsyncWriter, optional): Background writer to hand the job to. Default is None.
+
+    Returns:
+        None
+    """
+    if writer is None:
+        func(*args)
+    else:
+        file_path.touch()
+        writer.submit(func, *args)
+
+def _dump_json(path : Path, obj : dict) -> None:
+    """
+    Writes a JSON file atomically (temp file + os.replace), so a reader on another thread, e.g.
+    load_params while an AsyncWriter updates types.json, never sees a partial file.
+    """
+    path = Path(path)
+    tmp_path = path.with_name(path.name + '.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+def open_array(name : str, file_type : str, pattern_fn, shape : tuple, dtype=np.float32) -> np.memmap:
+    """
+    Creates a memory-mapped .npy file that can be filled in chunks (see AsyncWriter.write_chunk).
+
+    Args:
+        name (str): Main identifier (e.g., protein name).
+        file_type (str): Subdirectory (e.g., 'flow', 'trajectory').
+        pattern_fn (callable): Function that takes an integer and returns a file name.
+        shape (tuple): Shape of the full array.
+        dtype (np.dtype): Data type of the array. Default is np.float32.
+
+    Returns:
+        np.memmap: Writable array backed by a unique file in the given subdirectory.
+    """
+    file_path = get_unique_path(name, file_type, pattern_fn)
+    return np.lib.format.open_memmap(file_path, mode='w+', dtype=dtype, shape=shape)
+
+def open_arr(name : str, shape : tuple, dtype) -> np.memmap:
+    """
+    Creates the memory-mapped 'arr.npy' of a stack, for stacks too large to hold in memory.
+
+    Args:
+        name (str): The name of the stack.
+        shape (tuple): Shape of the stack, (n_frames, n_channels, height, width).
+        dtype (np.dtype): Data type of the stack.
+
+    Returns:
+        np.memmap: Writable array backed by main_path / name / 'arr.npy'.
+    """
+    save_dir = main_path / name
+    save_dir.mkdir(parents=True, exist_ok=True)
+    return np.lib.format.open_memmap(save_dir / 'arr.npy', mode='w+', dtype=dtype, shape=shape)
+
+def open_flow(name : str, shape : tuple, dtype=np.float32) -> tuple:
+    """
+    Creates a memory-mapped optical flow file with the same naming scheme as save_flow.
+
+    Args:
+        name (str): The name of the stack.
+        shape (tuple): Shape of the full flow array, e.g. (N-1, 3, H, W, 2).
+        dtype (np.dtype): Data type of the array. Default is np.float32.
+
+    Returns:
+        tuple: (np.memmap, int), the writable flow array and its tag, i.e. the i in '_fi'.
+    """
+    pattern_fn = lambda i: f"{name}_f{i}.npy"
+    tag = get_unique_index(name, 'flow', pattern_fn, aliases=('.npz',))
+    file_path = main_path / name / 'flow' / pattern_fn(tag)
+    return np.lib.format.open_memmap(file_path, mode='w+', dtype=dtype, shape=shape), tag
+
+def open_smoothed_flow(name : str, ftag, shape : tuple, dtype=np.float32) -> np.memmap:
+    """
+    Creates a memory-mapped file for a smoothed version of a flow, '<name>_f<ftag>sj.npy' (s for
+    smoothed), so a flow can be smoothed with several settings without overwriting any of them.
+
+    Args:
+        name (str): The name of the stack.
+        ftag (int | str): Tag of the flow that is smoothed, i.e. the i in '_fi'.
+        shape (tuple): Shape of the full flow array.
+        dtype (np.dtype): Data type of the array. Default is np.float32.
+
+    Returns:
+        np.memmap: Writable flow array.
+    """
+    return open_array(name, 'flow', lambda j: f"{name}_f{ftag}s{j}.npy", shape, dtype)
+
+class AppendableArray():
+    APPENDABLE_HEADER = 256 # bytes reserved for the .npy header, so the shape can grow in place
+
+    def __init__(self, path : Path, frame_shape : tuple = None, dtype=np.float32):
+        """
+        A .npy file that can grow along its first axis, e.g. a flow that is extended as frames arrive.
+
+        The file is a regular .npy (np.load works at any time), but its header is padded to a fixed
+        size so that appending only writes the new data and rewrites the shape in place.
+
+        Args:
+            path (Path): Path of the file. Opened if it exists, created (with 0 frames) otherwise.
+            frame_shape (tuple, optional): Shape of one entry along the first axis. Required when creating.
+            dtype (np.dtype): Data type when creating. Default is np.float32.
+
+        Attributes:
+            path (Path): Path of the file.
+            frame_shape (tuple): Shape of one entry.
+            dtype (np.dtype): Data type.
+            length (int): Number of entries currently stored.
+        """
+        self.path = Path(path)
+        if self.path.exists():
+            with open(self.path, 'rb') as f:
+                version = np.lib.format.read_magic(f)
+                assert version == (1, 0), f"{self.path} was not created as an appendable array"
+                shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                assert f.tell() == self.APPENDABLE_HEADER, f"{self.path} was not created as an appendable array"
+            self.length, self.frame_shape, self.dtype = shape[0], tuple(shape[1:]), dtype
+        else:
+            self.length, self.frame_shape, self.dtype = 0, tuple(frame_shape), np.dtype(dtype)
+            with open(self.path, 'wb') as f:
+                f.write(self._header())
+
+    def _header(self) -> bytes:
+        header = {'descr': np.lib.format.dtype_to_descr(self.dtype), 'fortran_order': False,
+                  'shape': (self.length,) + self.frame_shape}
+        text = repr(header).encode('latin1')
+        magic = np.lib.format.magic(1, 0)
+        padding = self.APPENDABLE_HEADER - len(magic) - 2 - len(text) - 1
+        assert padding >= 0, "Shape too long for the reserved header"
+        return magic + struct.pack('<H', self.APPENDABLE_HEADER - len(magic) - 2) + text + b' ' * padding + b'\n'
+
+    def append(self, arr : np.ndarray) -> None:
+        """
+        Appends entries along the first axis, right after the last counted entry.
+
+        Args:
+            arr (np.ndarray): Array of shape (k,) + frame_shape.
+
+        Returns:
+            None
+        """
+        assert tuple(arr.shape[1:]) == self.frame_shape, f"Expected entries of shape {self.frame_shape}, got {arr.shape[1:]}"
+        frame_nbytes = int(np.prod(self.frame_shape)) * self.dtype.itemsize
+        with open(self.path, 'r+b') as f:
+            # a killed append can leave bytes past the counted entries, they are overwritten
+            f.seek(self.APPENDABLE_HEADER + self.length * frame_nbytes)
+            f.truncate()
+            f.write(np.ascontiguousarray(arr, dtype=self.dtype).tobytes())
+            f.flush() # data before header, so the header never counts unwritten entries
+            self.length += arr.shape[0]
+            f.seek(0)
+            f.write(self._header())
+
 # saving
-def save_type(stacktype : str, params : dict) -> None:
+def save_type(stacktype : str, params : dict, writer=None) -> None:
     """
     Saves the type of stack to the types.json file.
     
     Args:
         stacktype (str): The type of stack to save.
-        **kwargs: Additional keyword arguments that can include:
+        params (dict): Parameters that can include:
             - process: parameters for preprocessing the stack.
             - flow: parameters for optical flow calculation.
             - trajectory: parameters for trajectory calculation.
+        writer (AsyncWriter, optional): Background writer to perform the save. Default is None.
     
     Returns:
         None: Just saves the type to the types.json file.
     """
-    with open(types_path, 'r') as f:
-        types = json.load(f)
-
-    types[stacktype] = params
-
-    with open(types_path, 'w') as f:
-        json.dump(types, f, indent=2)
+    def update_types():
+        with open(types_path, 'r') as f:
+            types = json.load(f)
+        types[stacktype] = params
+        _dump_json(types_path, types)
+
+    if writer is None:
+        update_types()
+    else:
+        writer.submit(update_types)
 
-def save_meta(path : str, stacktype : str, name : str) -> None:
+def save_meta(path : str, stacktype : str, name : str, writer=None) -> None:
     """
     Saves metadata about the stack to a JSON file.
     Args:
         path (str): The path where the metadata file will be saved.
         stacktype (str): The type of the stack.
         name (str): The name of the stack.
+        writer (AsyncWriter, optional): Background writer to perform the save. Default is None.
 
     Returns:
         None: Just saves the metadata to the specified path.
@@ -93,22 +279,23 @@ def save_meta(path : str, stacktype : str, name : str) -> None:
     meta = {'path' : path, 'stacktype' : stacktype, 'name' : name}
     meta_path = main_path / name
     meta_path.mkdir(parents=True, exist_ok=True)
-    with open(meta_path / 'meta.json', 'w') as f:
-        json.dump(meta, f, indent=2)
+    _write(meta_path / 'meta.json', _dump_json, meta_path / 'meta.json', meta, writer=writer)
 
-def save_arr(name : str, arr : np.array) -> None:
+def save_arr(name : str, arr : np.array, writer=None) -> None:
     """
     Saves a numpy array to a file.
     
     Args:
         arr (np.array): The numpy array to save.
+        writer (AsyncWriter, optional): Background writer to perform the save. Default is None.
     
     Returns:
         None: Just saves the array to a file.
     """
-    np.save(main_path / name / 'arr', arr)
+    file_path = main_path / name / 'arr.npy'
+    _write(file_path, np.save, file_path, arr, writer=writer)
 
-def save_flow(name : str, arr : np.array):
+def save_flow(name : str, arr : np.array, writer=None) -> Path:
     """
     Saves the optical flow array.
     
@@ -117,14 +304,83 @@ def save_flow(name : str, arr : np.array):
         arr (np.array): The optical flow or trajectory array to save, expected to be of shape (T, H, W, 2)
             where T is the number of frames, H is height, W is width, and the last dimension contains
             the flow vectors (dx, dy) or trajectory vectors.
+        writer (AsyncWriter, optional): Background writer to perform the save. Default is None.
     
     Returns:
-        None: Just saves the array to a file.
+        Path: Path the flow is (or will be) saved to.
     """
-    file_path = get_unique_path(name, 'flow', lambda i: f"{name}_f{i}.npy")
-    np.save(file_path, arr)
+    file_path = get_unique_path(name, 'flow', lambda i: f"{name}_f{i}.npy", aliases=('.npz',))
+    _write(file_path, np.save, file_path, arr, writer=writer)
+    return file_path
 
-def save_trajectory(name : str, ftag : str, arr : np.array) -> None:
+def flow_path(name : str, ftag) -> Path:
+    """
+    Returns the path of a saved (dense) optical flow.
+
+    Args:
+        name (str): The name of the stack.
+        ftag (int | str): Tag of the flow, i.e. the i in '_fi'.
+
+    Returns:
+        Path: Path of the flow file.
+    """
+    return main_path / name / 'flow' / f"{name}_f{ftag}.npy"
+
+def save_sparse_flow(name : str, sflow, writer=None) -> Path:
+    """
+    Saves a mask-restricted (sparse) optical flow. It shares the '_fi' tags with dense flows, but is
+    stored as an .npz file (see SparseFlow.save).
+
+    Args:
+        name (str): The name of the file.
+        sflow (SparseFlow): The sparse flow to save.
+        writer (AsyncWriter, optional): Background writer to perform the save. Default is None.
+
+    Returns:
+        Path: Path the flow is (or will be) saved to.
+    """
+    file_path = get_unique_path(name, 'flow', lambda i: f"{name}_f{i}.npz", aliases=('.npy',))
+    _write(file_path, sflow.save, file_path, writer=writer)
+    return file_path
+
+def open_multi_lag_flow(name : str, shapes : dict, stride : int = 1, dtype=np.float32) -> dict:
+    """
+    Creates the folder of a multi-lag flow in flow/, '<name>_mi/', holding a memory-mapped
+    'lag_L.npy' for every lag L and a 'lags.json' with the lags and stride, so the flows can be
+    filled in chunks (see flow.multi_lag_flow) instead of being held in memory.
+
+    Args:
+        name (str): The name of the stack.
+        shapes (dict): {lag: shape of that lag's flow}, e.g. from flow.multi_lag_shapes.
+        stride (int): Stride the flows are computed with. Default is 1.
+        dtype (np.dtype): Data type of the arrays. Default is np.float32.
+
+    Returns:
+        dict: {lag: np.memmap}.
+    """
+    save_dir = get_unique_path(name, 'flow', lambda i: f"{name}_m{i}")
+    save_dir.mkdir()
+    _dump_json(save_dir / 'lags.json', {'lags': sorted(int(lag) for lag in shapes), 'stride': stride})
+    return {lag: np.lib.format.open_memmap(save_dir / f"lag_{lag}.npy", mode='w+', dtype=dtype, shape=shape)
+            for lag, shape in shapes.items()}
+
+def load_multi_lag_flow(path) -> dict:
+    """
+    Loads a folder created with open_multi_lag_flow. Arrays are memory-mapped, so only the lags
+    (and frames) that are actually used get read from disk.
+
+    Args:
+        path (str | Path): Folder of the multi-lag flow.
+
+    Returns:
+        dict: {lag: np.ndarray}.
+    """
+    path = Path(path)
+    with open(path / 'lags.json', 'r') as f:
+        lags = json.load(f)['lags']
+    return {lag: np.load(path / f"lag_{lag}.npy", mmap_mode='r') for lag in lags}
+
+def save_trajectory(name : str, ftag : str, arr : np.array, writer=None) -> None:
     """
     Saves the trajectory flow array.
 
@@ -134,6 +390,7 @@ def save_trajectory(name : str, ftag : str, arr : np.array) -> None:
         ftag (str): The tag associated with the optical flow file the trajectory was derived from.
             where T is the number of frames, H is height, W is width, and the last dimension contains
             the flow vectors (dx, dy) or trajectory vectors.
+        writer (AsyncWriter, optional): Background writer to perform the save. Default is None.
     
     Returns:
         None: Just saves the array to a file.
@@ -148,7 +405,23 @@ def save_trajectory(name : str, ftag : str, arr : np.array) -> None:
         return tag
 
     file_path = get_unique_path(name, 'trajectory', lambda i: f"{name}_t{ftag}{number_to_tag(i)}.npy")
-    np.save(file_path, arr)
+    _write(file_path, np.save, file_path, arr, writer=writer)
+
+def save_tracks(name : str, table : np.ndarray, writer=None) -> Path:
+    """
+    Saves a sparse feature track table (see trajectory.track_features).
+
+    Args:
+        name (str): The name of the file.
+        table (np.ndarray): Structured array with fields (id, frame, x, y, status).
+        writer (AsyncWriter, optional): Background writer to perform the save. Default is None.
+
+    Returns:
+        Path: Path the table is (or will be) saved to.
+    """
+    file_path = get_unique_path(name, 'trajectory', lambda i: f"{name}_k{i}.npy")
+    _write(file_path, np.save, file_path, table, writer=writer)
+    return file_path
 
 def save_original_video(name : str, **kwargs) -> None:
     """
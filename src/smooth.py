@@ -0,0 +1,165 @@
+import cv2
+import numpy as np
+from collections import deque
+from src.governor import ResourceGovernor, frame_bytes
+
+TEMPORAL_FILTERS = ('median', 'ema', None)
+
+class FlowSmoother():
+    def __init__(self, temporal : str = 'median', window : int = 5, alpha : float = 0.5, sigma : float = 1.0):
+        """
+        Smooths a flow frame by frame as it is produced, keeping only a sliding window in memory.
+
+        Every frame is first blurred spatially (a Gaussian on dx and dy), then filtered over time:
+        - 'median': centered median over `window` frames. A frame is emitted once the window after
+          it has arrived, the last window // 2 frames are emitted by `flush` (with shorter windows
+          at both ends of the flow, so every frame is kept).
+        - 'ema': exponential moving average s_t = alpha * v_t + (1 - alpha) * s_{t-1}, emitted right away.
+        - None: spatial smoothing only.
+
+        Args:
+            temporal (str): Temporal filter, 'median', 'ema' or None. Default is 'median'.
+            window (int): Odd number of frames of the median window. Default is 5.
+            alpha (float): Weight of the newest frame in the EMA, in (0, 1]. Default is 0.5.
+            sigma (float): Standard deviation of the spatial Gaussian in pixels, 0 to disable. Default is 1.0.
+        """
+        assert temporal in TEMPORAL_FILTERS, f"Unknown temporal filter: {temporal}"
+        assert window % 2 == 1, f"Median window must be odd, got {window}"
+        assert 0 < alpha <= 1, f"EMA alpha must be in (0, 1], got {alpha}"
+        self.temporal = temporal
+        self.window = window
+        self.alpha = alpha
+        self.sigma = sigma
+        self._buffer = deque(maxlen=window)
+        self._state = None
+        self._seen = 0 # frames pushed
+        self._emitted = 0 # frames returned
+        self._frame_shape = None
+
+    def _spatial(self, frame : np.ndarray) -> np.ndarray:
+        """
+        Blurs one frame of shape (..., H, W, 2).
+        """
+        frame = np.asarray(frame, dtype=np.float32)
+        if not self.sigma:
+            return frame.copy()
+        out = np.empty_like(frame)
+        flat_in, flat_out = frame.reshape(-1, *frame.shape[-3:]), out.reshape(-1, *frame.shape[-3:])
+        for i in range(len(flat_in)):
+            flat_out[i] = cv2.GaussianBlur(flat_in[i], (0, 0), self.sigma)
+        return out
+
+    def _median(self, lo : int, hi : int) -> np.ndarray:
+        """
+        Median over the buffered frames with stream positions lo..hi-1.
+        """
+        first = self._seen - len(self._buffer)
+        frames = list(self._buffer)[lo - first:hi - first]
+        return np.median(np.stack(frames), axis=0).astype(np.float32)
+
+    def push(self, frames : np.ndarray) -> np.ndarray:
+        """
+        Adds frames to the stream.
+
+        Args:
+            frames (np.ndarray): Next frames of the flow, shape (k, ..., H, W, 2).
+
+        Returns:
+            np.ndarray: Smoothed frames that are complete, shape (j, ..., H, W, 2) with j <= k (j may be 0).
+                They continue where the previous call left off.
+        """
+        out = []
+        half = self.window // 2
+        self._frame_shape = frames.shape[1:]
+        for frame in frames:
+            frame = self._spatial(frame)
+            if self.temporal == 'ema':
+                self._state = frame if self._state is None else self.alpha * frame + (1 - self.alpha) * self._state
+                out.append(self._state)
+            elif self.temporal == 'median':
+                self._buffer.append(frame)
+                self._seen += 1
+                t = self._seen - 1 - half
+                if t >= 0:
+                    out.append(self._median(max(t - half, 0), self._seen))
+            else:
+                out.append(frame)
+        return self._emit(out)
+
+    def flush(self) -> np.ndarray:
+        """
+        Emits the frames still waiting for their window (median only) and resets the smoother.
+
+        Returns:
+            np.ndarray: The remaining smoothed frames, shape (j, ..., H, W, 2).
+        """
+        out = []
+        if self.temporal == 'median':
+            half = self.window // 2
+            for t in range(self._emitted, self._seen):
+                out.append(self._median(max(t - half, 0), self._seen))
+        out = self._emit(out)
+        self._buffer.clear()
+        self._state = None
+        self._seen = self._emitted = 0
+        return out
+
+    def _emit(self, out : list) -> np.ndarray:
+        self._emitted += len(out)
+        frame_shape = self._frame_shape if self._frame_shape is not None else (0, 0, 2)
+        return np.stack(out) if out else np.empty((0,) + tuple(frame_shape), dtype=np.float32)
+
+    def window_bytes(self, frame_shape : tuple) -> int:
+        """
+        Memory the smoother holds between calls for frames of shape frame_shape.
+        """
+        frames = self.window if self.temporal == 'median' else 1
+        return frames * frame_bytes(frame_shape, np.float32)
+
+def smooth_flow(flow : np.ndarray, out : np.ndarray, governor : ResourceGovernor = None, writer=None, **kwargs) -> np.ndarray:
+    """
+    Streams a (memory-mapped) flow through a FlowSmoother into `out`, a chunk of frames at a time.
+
+    With a writer, half the budget is kept free for the chunks queued in it, and every chunk stays
+    reserved with the governor until it has been written, so a slow disk blocks the smoothing
+    instead of letting the queue grow.
+
+    Args:
+        flow (np.ndarray): Flow of shape (T, ..., H, W, 2), e.g. a np.memmap or FlowResult.
+        out (np.ndarray): Preallocated output of the same shape, e.g. from memory.open_smoothed_flow.
+        governor (ResourceGovernor, optional): Decides the chunk size. Default is a new governor.
+        writer (AsyncWriter, optional): Writes the chunks of `out` in the background. Default is None.
+        **kwargs: Smoothing parameters (see FlowSmoother).
+
+    Returns:
+        np.ndarray: out.
+    """
+    governor = governor or ResourceGovernor()
+    smoother = FlowSmoother(**kwargs)
+    frame_shape = flow.shape[1:]
+    item_bytes = 3 * frame_bytes(frame_shape, np.float32) # input, blurred and smoothed frame
+    fixed_bytes = smoother.window_bytes(frame_shape)
+    if writer is not None:
+        fixed_bytes += governor.max_memory // 2 # room for the chunks queued in the writer
+    chunk_size, _ = governor.plan('smoothing', flow.shape[0], item_bytes, fixed_bytes=fixed_bytes)
+
+    pos = 0
+    for start in range(0, flow.shape[0], chunk_size):
+        stop = min(start + chunk_size, flow.shape[0])
+        with governor.reserve((stop - start) * item_bytes, writer):
+            smoothed = smoother.push(np.asarray(flow[start:stop]))
+            pos = store_frames(out, pos, smoothed, writer)
+    with governor.reserve(smoother.window_bytes(frame_shape), writer):
+        store_frames(out, pos, smoother.flush(), writer)
+    return out
+
+def store_frames(out : np.ndarray, pos : int, chunk : np.ndarray, writer=None) -> int:
+    """
+    Writes chunk into out at pos, through the writer if there is one, and returns the next position.
+    """
+    if len(chunk):
+        if writer is not None:
+            writer.write_chunk(out, pos, chunk)
+        else:
+            out[pos:pos + len(chunk)] = chunk
+    return pos + len(chunk)
@@ -0,0 +1,163 @@
+import numpy as np
+from pathlib import Path
+
+class SparseFlow():
+    def __init__(self, frame_shape : tuple, indptr : np.ndarray, index : np.ndarray, values : np.ndarray):
+        """
+        Optical flow stored only at the pixels inside a mask (CSR-style, one row per frame).
+
+        Frame t owns entries indptr[t]:indptr[t+1]. For those entries, `index` holds the flat
+        pixel index (y * W + x) and `values` the (dx, dy) vector of every channel.
+
+        Args:
+            frame_shape (tuple): (H, W) of the original frames.
+            indptr (np.ndarray): Array of shape (T+1,) with the start of every frame's entries.
+            index (np.ndarray): Array of shape (nnz,) with flat pixel indices.
+            values (np.ndarray): Array of shape (nnz, C, 2) with the flow vectors of every channel.
+
+        Attributes:
+            frame_shape (tuple): (H, W) of the original frames.
+            n_frames (int): Number of flow frames T.
+            n_channels (int): Number of channels C.
+            nnz (int): Number of stored pixels over all frames.
+        """
+        self.frame_shape = tuple(int(s) for s in frame_shape)
+        self.indptr = np.asarray(indptr, dtype=np.int64)
+        self.index = np.asarray(index)
+        self.values = np.asarray(values)
+        if self.values.ndim == 2:
+            self.values = self.values[:, None, :]
+        self.n_frames = len(self.indptr) - 1
+        self.n_channels = self.values.shape[1]
+        self.nnz = int(self.indptr[-1])
+
+    @property
+    def shape(self) -> tuple:
+        """
+        Shape of the equivalent dense array, (T, C, H, W, 2).
+        """
+        return (self.n_frames, self.n_channels) + self.frame_shape + (2,)
+
+    @property
+    def density(self) -> float:
+        """
+        Fraction of pixels that are stored.
+        """
+        return self.nnz / max(self.n_frames * self.frame_shape[0] * self.frame_shape[1], 1)
+
+    @classmethod
+    def from_masks(cls, masks : np.ndarray, values : list) -> 'SparseFlow':
+        """
+        Builds a SparseFlow from per-frame masks and the flow values inside them.
+
+        Args:
+            masks (np.ndarray): Boolean array of shape (T, H, W).
+            values (list[np.ndarray]): Per frame, an array of shape (k, 2) or (k, C, 2) holding the
+                flow at np.flatnonzero(masks[t]), in that (row-major) order.
+
+        Returns:
+            SparseFlow: The sparse flow.
+        """
+        h, w = masks.shape[1:]
+        index_dtype = np.int32 if h * w < 2**31 else np.int64
+        index = [np.flatnonzero(m).astype(index_dtype) for m in masks]
+        indptr = np.concatenate([[0], np.cumsum([len(i) for i in index])])
+        values = [v if v.ndim == 3 else v[:, None, :] for v in values]
+        return cls((h, w), indptr, np.concatenate(index), np.concatenate(values).astype(np.float32))
+
+    def frame(self, t : int, channel : int = None) -> tuple:
+        """
+        Returns the stored pixels of one frame.
+
+        Args:
+            t (int): Frame index.
+            channel (int, optional): Channel to return. Default is None (all channels).
+
+        Returns:
+            tuple: (ys, xs, values), values of shape (k, 2) for a single channel or (k, C, 2) otherwise.
+        """
+        lo, hi = self.indptr[t], self.indptr[t + 1]
+        ys, xs = np.divmod(self.index[lo:hi], self.frame_shape[1])
+        values = self.values[lo:hi]
+        if channel is not None:
+            values = values[:, channel]
+        return ys, xs, values
+
+    def mask(self, t : int) -> np.ndarray:
+        """
+        Returns the boolean mask of the stored pixels of frame t, shape (H, W).
+        """
+        mask = np.zeros(self.frame_shape, dtype=bool)
+        mask.flat[self.index[self.indptr[t]:self.indptr[t + 1]]] = True
+        return mask
+
+    def to_dense(self, channel : int = None, frames : slice = slice(None)) -> np.ndarray:
+        """
+        Expands (a range of) the flow to a dense array, with zeros outside the mask.
+
+        Args:
+            channel (int, optional): Channel to expand. Default is None (all channels).
+            frames (slice): Frames to expand. Default is all frames.
+
+        Returns:
+            np.ndarray: Array of shape (T, H, W, 2) for a single channel or (T, C, H, W, 2) otherwise.
+        """
+        ts = range(self.n_frames)[frames]
+        h, w = self.frame_shape
+        if channel is None:
+            out = np.zeros((len(ts), self.n_channels, h * w, 2), dtype=self.values.dtype)
+            for i, t in enumerate(ts):
+                lo, hi = self.indptr[t], self.indptr[t + 1]
+                out[i][:, self.index[lo:hi]] = self.values[lo:hi].transpose(1, 0, 2)
+            return out.reshape(len(ts), self.n_channels, h, w, 2)
+
+        out = np.zeros((len(ts), h * w, 2), dtype=self.values.dtype)
+        for i, t in enumerate(ts):
+            lo, hi = self.indptr[t], self.indptr[t + 1]
+            out[i][self.index[lo:hi]] = self.values[lo:hi, channel]
+        return out.reshape(len(ts), h, w, 2)
+
+    def save(self, path) -> None:
+        """
+        Saves the sparse flow as an .npz file.
+
+        Args:
+            path (str | Path): Destination file.
+
+        Returns:
+            None
+        """
+        np.savez(path, frame_shape=np.array(self.frame_shape), indptr=self.indptr,
+                 index=self.index, values=self.values)
+
+    @classmethod
+    def load(cls, path) -> 'SparseFlow':
+        """
+        Loads a sparse flow saved with `save`.
+
+        Args:
+            path (str | Path): .npz file to load.
+
+        Returns:
+            SparseFlow: The sparse flow.
+        """
+        with np.load(Path(path)) as data:
+            return cls(tuple(data['frame_shape']), data['indptr'], data['index'], data['values'])
+
+def combine_sparse_flows(flow_list : list) -> SparseFlow:
+    """
+    Sparse counterpart of flow.combine_flows: stacks the summed flow and both channel flows.
+
+    Both flows must have been computed with the same masks, so their entries line up.
+
+    Args:
+        flow_list (list[SparseFlow]): Two single-channel sparse flows.
+
+    Returns:
+        SparseFlow: Sparse flow with channels (sum, first, second).
+    """
+    a, b = flow_list
+    assert np.array_equal(a.indptr, b.indptr) and np.array_equal(a.index, b.index), "Sparse flows must share masks"
+    va, vb = a.values[:, 0], b.values[:, 0]
+    values = np.stack([va + vb, va, vb], axis=1)
+    return SparseFlow(a.frame_shape, a.indptr, a.index, values)
@@ -4,33 +4,50 @@ import tifffile as tiff
 import src.flow as flow
 import src.memory as mem
 import src.trajectory as traj
+import src.mask as mask
+from src.sparseflow import SparseFlow, combine_sparse_flows
+from src.flowresult import FlowResult
+from src.smooth import FlowSmoother, smooth_flow, store_frames
+from src.governor import ResourceGovernor, frame_bytes, format_bytes
 from src.tiffvisualize import create_vector_field_video, create_orginal_video
-from src.defaults import default_process, default_flow, default_trajectory
+from src.defaults import default_process, default_flow, default_trajectory, default_mask, default_tracking, default_multi_lag, default_smooth
 
 class TiffStack():
-    def __init__(self, path, stacktype, name = None, n_channels = 3, dtype = np.uint16):
+    def __init__(self, path, stacktype, name = None, n_channels = 3, dtype = np.uint16, writer = None, governor = None):
         """
         Initializes a TiffStack object by loading a TIFF file and extracting its frames.
         Args:
             path (str): Path to the TIFF file.
             n_channels (int): Number of channels in the TIFF stack. Default is 3.
             dtype (np.dtype): Data type of the image frames. Default is np.uint16.
+            writer (AsyncWriter, optional): Background writer used for every save made by this stack.
+                Call writer.flush() to wait for (and surface errors from) pending writes. Default is None.
+            governor (ResourceGovernor, optional): Memory/worker budget consulted by every stage.
+                Default is a new governor (half the available memory, cpu_count() workers).
         
         Attributes:
             path (str): Path to the TIFF file.
             timestamp (str): Timestamp of when the TIFF file was loaded.
             tags (list): List of tags for each frame in the TIFF stack.
             arr (np.ndarray): 4D numpy array containing the image frames, shape is (n_frames, n_channels, height, width).
+            smoothed_flow (FlowResult): Smoothed flow of the last calculate_optical_flow(smooth=True) or
+                smooth_flow call, None until then.
         """
         self.path = path
         self.stacktype = stacktype
         self.n_channels = n_channels
         self.dtype = dtype
+        self.writer = writer
+        self.governor = governor if governor is not None else ResourceGovernor()
+        self.smoothed_flow = None
         if name is None:
             self.name = self._get_name()
         else:
             self.name = name
 
+        if not mem.main_path.exists():
+            mem.init_memory() 
+
         try:
             with tiff.TiffFile(path) as img:
                 total_pages = len(img.pages)
@@ -41,7 +58,7 @@ class TiffStack():
                 ref_dtype = img.pages[0].dtype
                 assert ref_dtype == dtype, f"Expected dtype {dtype}, but got {ref_dtype}"
 
-                self.arr = np.empty((n_frames, n_channels, ref_shape[0], ref_shape[1]), dtype=dtype)
+                self.arr = self._allocate((n_frames, n_channels, ref_shape[0], ref_shape[1]))
                 for i in range(n_frames):
                     for c in range(n_channels):
                         page_idx = i * n_channels + c
@@ -49,13 +66,39 @@ class TiffStack():
 
         except Exception as e:
             print(f"Error loading TIFF file: {e}")
-        
-        if not mem.main_path.exists():
-            mem.init_memory() 
 
         self.params = mem.load_params(self.stacktype)
         self.save_TiffStack()
     
+    def _allocate(self, shape : tuple) -> np.ndarray:
+        """
+        Allocates the array the stack is loaded into. Stacks that would take more than half of the
+        governor's budget are memory-mapped straight to their 'arr.npy' instead of being held in
+        memory, so the stages have at least the other half for their chunks (see _held_bytes).
+
+        Args:
+            shape (tuple): Shape of the stack, (n_frames, n_channels, height, width).
+
+        Returns:
+            np.ndarray: Empty (possibly memory-mapped) array.
+        """
+        nbytes = frame_bytes(shape, self.dtype)
+        if self.governor.fits(2 * nbytes):
+            self.governor.log(f"load: holding {format_bytes(nbytes)} stack in memory")
+            return np.empty(shape, dtype=self.dtype)
+        self.governor.log(f"load: {format_bytes(nbytes)} stack exceeds half the budget, memory-mapping to arr.npy")
+        return mem.open_arr(self.name, shape, self.dtype)
+
+    def _held_bytes(self, *arrays) -> int:
+        """
+        Memory held by the stack and the given intermediate arrays (e.g. preprocessed stacks), which
+        every stage has to fit its chunks beside. Memory-mapped arrays don't count.
+
+        Returns:
+            int: Number of bytes.
+        """
+        return sum(arr.nbytes for arr in (self.arr,) + arrays if not isinstance(arr, np.memmap))
+
     def _get_name(self) -> str:
         """
         Generates a name for the TiffStack based on the file name.
@@ -77,9 +120,12 @@ class TiffStack():
         Returns:
             None, just saves the object.
         """
-        mem.save_type(self.stacktype, self.params)
-        mem.save_meta(self.path, self.stacktype, self.name)
-        mem.save_arr(self.name, self.arr)
+        mem.save_type(self.stacktype, self.params, writer=self.writer)
+        mem.save_meta(self.path, self.stacktype, self.name, writer=self.writer)
+        if isinstance(self.arr, np.memmap):
+            self.arr.flush() # already lives in arr.npy
+        else:
+            mem.save_arr(self.name, self.arr, writer=self.writer)
     
     def isolate_channel(self, channel_idx : int) -> np.ndarray:
         """
@@ -94,47 +140,239 @@ class TiffStack():
         assert 0 <= channel_idx < self.arr.shape[1], f"Channel index out of range: {channel_idx}"
         return self.arr[:, channel_idx, ...]
     
-    def calculate_optical_flow(self, process_args=None, flow_args=None, default=False) -> np.ndarray:
+    def calculate_optical_flow(self, process_args=None, flow_args=None, default=False, smooth=False, smooth_args=None) -> FlowResult:
         """
         Computes optical flow between the first two channels of the TIFF stack using the Farneback method.
 
+        The stack is processed in blocks of frame pairs sized by the governor. Each frame is
+        preprocessed once (the last frame of a block is carried over to the next one). If the full
+        flow doesn't fit into the budget, or a writer is set, the result is streamed block by block
+        into a memory-mapped flow file instead of being held in memory. With a writer, half the
+        budget is kept free so one block can be written while the next one is computed, and the
+        writer is flushed before returning so the result never shows frames still in the queue.
+
+        With smooth=True, every block is also passed through a FlowSmoother as it is produced
+        (temporal median or EMA and spatial Gaussian, see smooth.FlowSmoother), which only holds its
+        sliding window. The smoothed flow is streamed into its own file '<name>_fisj.npy' next to the
+        raw flow '<name>_fi.npy', so in that case the raw flow is always streamed to disk as well.
+        The smoothed flow is then available as self.smoothed_flow (or load_flow('<i>s<j>')).
+
         Args:
             process_args (dict): Preprocessing steps and parameters.
             flow_args (dict): Parameters for optical flow calculation.
             default (bool): Use default optical flow parameters if True.
+            smooth (bool): Also compute a smoothed flow. Default is False.
+            smooth_args (dict, optional): Smoothing parameters. Default is the stack type's or default_smooth.
 
         Returns:
-            np.ndarray: Combined flow vectors of shape (N-1, H, W, 2).
+            FlowResult: Handle to the combined flow vectors of shape (N-1, 3, H, W, 2), backed by a
+                np.memmap if streamed. Index it like an array, or use its cached magnitude/angle.
         """
         if process_args is None:
             process_args = self.params.get('preprocess', default_process)
         if flow_args is None:
             flow_args = self.params.get('optical_flow', default_flow)
+        if default:
+            flow_args = default_flow
+        if smooth and smooth_args is None:
+            smooth_args = self.params.get('smooth', default_smooth)
+        smoother = FlowSmoother(**smooth_args) if smooth else None
 
-        def compute_flow_for_channel(channel_idx):
-            frames = self.isolate_channel(channel_idx)
-            processed = flow.preprocess_stack(frames, **process_args)
-            if default:
-                return flow.optical_flow(processed)
-            else:
-                return flow.optical_flow(
-                    processed,
-                    flow_args['pyr_scale'],
-                    flow_args['levels'],
-                    flow_args['winsize'],
-                    flow_args['iterations'],
-                    flow_args['poly_n'],
-                    flow_args['poly_sigma'],
-                    flow_args['flag']
-                )
-
-        flow_2 = compute_flow_for_channel(1)
-        flow_3 = compute_flow_for_channel(2)
-
-        combined = flow.combine_flows([flow_2, flow_3])
-        mem.save_flow(self.name, combined)
-        return combined
+        n, _, h, w = self.arr.shape
+        n_pairs = n - 1
+        out_shape = (n_pairs, 3, h, w, 2)
+        out_bytes = frame_bytes(out_shape, np.float32)
+        held = self._held_bytes()
+        stream = self.writer is not None or smoother is not None or not self.governor.fits(out_bytes + held)
+        if not stream:
+            fixed_bytes = held + out_bytes
+        elif self.writer is not None:
+            fixed_bytes = held + self.governor.max_memory // 2
+        else:
+            fixed_bytes = held
+
+        pair_bytes = (2 * (flow.preprocess_frame_bytes((h, w), self.dtype) + flow.flow_pair_bytes((h, w), self.dtype))
+                      + frame_bytes((3, h, w, 2), np.float32))
+        if smoother is not None:
+            pair_bytes += 2 * frame_bytes((3, h, w, 2), np.float32) # blurred and smoothed frame
+            fixed_bytes += smoother.window_bytes((3, h, w, 2))
+        chunk_size, workers = self.governor.plan('optical flow', n_pairs, pair_bytes, fixed_bytes=fixed_bytes)
+        if stream:
+            combined, ftag = mem.open_flow(self.name, out_shape)
+        else:
+            combined = np.empty(out_shape, dtype=np.float32)
+        if smoother is not None:
+            smoothed = mem.open_smoothed_flow(self.name, ftag, out_shape)
+            pos = 0
+
+        last = {} # last preprocessed frame of the previous block, per channel
+        with self.governor.executor(workers) as pool:
+            for start in range(0, n_pairs, chunk_size):
+                stop = min(start + chunk_size, n_pairs)
+                nbytes = (stop - start) * pair_bytes
+                with self.governor.reserve(nbytes, self.writer):
+                    flows = []
+                    for channel_idx in (1, 2):
+                        first = start + 1 if channel_idx in last else start
+                        processed = flow.preprocess_stack(self.arr[first:stop + 1, channel_idx], pool=pool, **process_args)
+                        if channel_idx in last:
+                            processed = np.concatenate([last[channel_idx][None], processed])
+                        last[channel_idx] = processed[-1]
+                        flows.append(flow.optical_flow(
+                            processed,
+                            flow_args['pyr_scale'],
+                            flow_args['levels'],
+                            flow_args['winsize'],
+                            flow_args['iterations'],
+                            flow_args['poly_n'],
+                            flow_args['poly_sigma'],
+                            flow_args['flag'],
+                            pool=pool
+                        ))
+                    chunk = flow.combine_flows(flows)
+
+                    if self.writer is not None:
+                        self.writer.write_chunk(combined, start, chunk)
+                    else:
+                        combined[start:stop] = chunk
+                    if smoother is not None:
+                        pos = store_frames(smoothed, pos, smoother.push(chunk), self.writer)
+
+        if smoother is not None:
+            store_frames(smoothed, pos, smoother.flush(), self.writer)
+        if not stream:
+            mem.save_flow(self.name, combined)
+        elif self.writer is None:
+            combined.flush()
+            if smoother is not None:
+                smoothed.flush()
+        else:
+            # the FlowResult caches what it reads, so queued chunks must have landed first
+            self.writer.flush()
+        if smoother is not None:
+            self.smoothed_flow = FlowResult(smoothed)
+        return FlowResult(combined)
+
+    def load_flow(self, ftag, cache_bytes : int = 512 * 1024**2) -> FlowResult:
+        """
+        Opens a saved optical flow of this stack lazily.
+
+        Args:
+            ftag (int | str): Tag of the flow, i.e. the i in '<name>_fi.npy'.
+            cache_bytes (int): Maximum size of the cache of derived quantities. Default is 512 MB.
+
+        Returns:
+            FlowResult: Memory-mapped handle to the flow.
+        """
+        return FlowResult(mem.flow_path(self.name, ftag), cache_bytes=cache_bytes)
+
+    def smooth_flow(self, ftag, smooth_args=None) -> FlowResult:
+        """
+        Smooths a saved optical flow of this stack into a new file '<name>_fisj.npy', reading it a
+        chunk of frames at a time (see smooth.smooth_flow).
+
+        Args:
+            ftag (int | str): Tag of the flow, i.e. the i in '<name>_fi.npy'.
+            smooth_args (dict, optional): Smoothing parameters. Default is the stack type's or default_smooth.
+
+        Returns:
+            FlowResult: Handle to the smoothed flow, also kept as self.smoothed_flow.
+        """
+        if smooth_args is None:
+            smooth_args = self.params.get('smooth', default_smooth)
+        source = np.load(mem.flow_path(self.name, ftag), mmap_mode='r')
+        smoothed = mem.open_smoothed_flow(self.name, ftag, source.shape)
+        smooth_flow(source, smoothed, governor=self.governor, writer=self.writer, **smooth_args)
+        if self.writer is None:
+            smoothed.flush()
+        else:
+            self.writer.flush()
+        self.smoothed_flow = FlowResult(smoothed)
+        return self.smoothed_flow
     
+    def calculate_multi_lag_flow(self, lags=None, stride=None, process_args=None, flow_args=None) -> dict:
+        """
+        Computes optical flow between frames i and i + lag for several lags at once.
+
+        Each channel is preprocessed once and shared by all lags, and the pairs of all lags are
+        scheduled as one job. The flows are streamed chunk by chunk into memory-mapped files in
+        flow/<name>_mi/ (see memory.open_multi_lag_flow), through the writer if one is set, so
+        displacement analyses over lags don't have to rerun anything.
+
+        Args:
+            lags (list[int]): Lags to compute. Default is defaults.default_multi_lag['lags'].
+            stride (int): Distance between the start frames of consecutive pairs. Default is 1.
+            process_args (dict): Preprocessing steps and parameters.
+            flow_args (dict): Parameters for optical flow calculation.
+
+        Returns:
+            dict: {lag: memory-mapped combined flow of shape (n_pairs, 3, H, W, 2)}.
+        """
+        multi_lag_args = self.params.get('multi_lag', default_multi_lag)
+        if lags is None:
+            lags = multi_lag_args['lags']
+        if stride is None:
+            stride = multi_lag_args['stride']
+        if process_args is None:
+            process_args = self.params.get('preprocess', default_process)
+        if flow_args is None:
+            flow_args = self.params.get('optical_flow', default_flow)
+
+        processed = []
+        for channel_idx in (1, 2):
+            processed.append(flow.preprocess_stack(self.isolate_channel(channel_idx), governor=self.governor,
+                                                   fixed_bytes=self._held_bytes(*processed), **process_args))
+        n, h, w = processed[0].shape
+        combined = mem.open_multi_lag_flow(self.name, flow.multi_lag_shapes(n, (h, w), lags, stride, n_channels=2), stride=stride)
+        flow.multi_lag_flow(processed, lags, stride, flow_args, governor=self.governor, out=combined, writer=self.writer,
+                            fixed_bytes=self._held_bytes(*processed))
+        if self.writer is None:
+            for arr in combined.values():
+                arr.flush()
+        return combined
+
+    def calculate_masked_flow(self, process_args=None, flow_args=None, mask_args=None) -> SparseFlow:
+        """
+        Computes optical flow like calculate_optical_flow, but only inside cell masks.
+
+        Masks are derived per frame from both preprocessed channels (see mask.cell_mask) and merged,
+        flow is computed only on the tiles covering them, and the result is stored sparsely as an
+        .npz file in flow/. Use this for fields of view that are mostly empty background.
+
+        Args:
+            process_args (dict): Preprocessing steps and parameters.
+            flow_args (dict): Parameters for optical flow calculation.
+            mask_args (dict): Mask and tiling parameters (see defaults.default_mask).
+
+        Returns:
+            SparseFlow: Sparse flow with channels (sum, channel 1, channel 2).
+        """
+        if process_args is None:
+            process_args = self.params.get('preprocess', default_process)
+        if flow_args is None:
+            flow_args = self.params.get('optical_flow', default_flow)
+        if mask_args is None:
+            mask_args = self.params.get('mask', default_mask)
+        mask_args = dict(mask_args)
+        tile = mask_args.pop('tile', default_mask['tile'])
+        pad = mask_args.pop('pad', default_mask['pad'])
+
+        processed = []
+        for c in (1, 2):
+            processed.append(flow.preprocess_stack(self.isolate_channel(c), governor=self.governor,
+                                                   fixed_bytes=self._held_bytes(*processed), **process_args))
+        held = self._held_bytes(*processed)
+        masks = mask.mask_stack(processed[0], governor=self.governor, fixed_bytes=held, **mask_args)
+        masks |= mask.mask_stack(processed[1], governor=self.governor, fixed_bytes=held + masks.nbytes, **mask_args)
+
+        held += masks.nbytes
+        flows = [flow.masked_optical_flow(p, masks, flow_args, tile=tile, pad=pad, governor=self.governor, fixed_bytes=held)
+                 for p in processed]
+        combined = combine_sparse_flows(flows)
+        self.governor.log(f"masked flow: kept {combined.density:.1%} of pixels")
+        mem.save_sparse_flow(self.name, combined, writer=self.writer)
+        return combined
+
     def save_orginal_video(self, idx : int = 0, 
                            figsize : int | int = (12, 8), fps : int = 10, cmap : str = 'gray') -> None:
         """
@@ -162,7 +400,7 @@ class TiffStack():
 
         create_vector_field_video(
             self.name, 
-            flow[:, idx, ...], 
+            flow.view(idx) if isinstance(flow, FlowResult) else flow[:, idx, ...], 
             og_arr, 
             step=step, 
             scale=scale,
@@ -180,4 +418,31 @@ class TiffStack():
         Returns:
             np.ndarray: Trajectory of the optical flow vectors.
         """
-        return traj.trajectory(flow)
\ No newline at end of file
+        return traj.trajectory(flow)
+
+    def calculate_tracks(self, channel_idx : int = 1, process_args=None, track_args=None) -> np.ndarray:
+        """
+        Tracks sparse features (cells, vesicles) of one channel with pyramidal Lucas-Kanade.
+
+        Much cheaper than dense optical flow when only a few hundred paths are needed. The track
+        table is saved to trajectory/ as '<name>_ki.npy'.
+
+        Args:
+            channel_idx (int): Index of the channel to track. Default is 1.
+            process_args (dict): Preprocessing steps and parameters.
+            track_args (dict): Tracking parameters (see defaults.default_tracking).
+
+        Returns:
+            np.ndarray: Track table, a structured array with fields (id, frame, x, y, status).
+        """
+        if process_args is None:
+            process_args = self.params.get('preprocess', default_process)
+        if track_args is None:
+            track_args = self.params.get('tracking', default_tracking)
+
+        processed = flow.preprocess_stack(self.isolate_channel(channel_idx), governor=self.governor,
+                                          fixed_bytes=self._held_bytes(), **process_args)
+        table = traj.track_features(processed, **track_args)
+        self.governor.log(f"tracking: {len(np.unique(table['id']))} tracks, {len(table)} rows")
+        mem.save_tracks(self.name, table, writer=self.writer)
+        return table
\ No newline at end of file
@@ -2,6 +2,9 @@ import cv2
 import numpy as np
 import matplotlib.pyplot as plt
 from src.memory import save_original_video, save_vector_video
+from src.governor import ResourceGovernor, frame_bytes
+from src.sparseflow import SparseFlow
+from src.flowresult import FlowResult
 
 import matplotlib.animation as animation
 
@@ -101,9 +104,46 @@ def plot_kymograph(line, ax=None, figsize=(10, 6), aspect='auto', cmap='PRGn', o
     if show:
         plt.show()
 
-def vector_kymograph(arr, values=['x dir'], method=np.median, combine=True, save_path=None):
+def sparse_kymograph(sflow : SparseFlow, value_fn, method=np.median, channel : int = 0) -> np.ndarray:
+    """
+    Reduces a sparse flow to a kymograph without expanding it, using only the pixels inside the mask.
+
+    Args:
+        sflow (SparseFlow): Sparse flow.
+        value_fn (callable): Maps the (k, 2) flow vectors of a frame to (k,) values (e.g. speed).
+        method (callable): np.median or np.mean, applied per image column. Default is np.median.
+        channel (int): Channel of the sparse flow to use. Default is 0.
+
+    Returns:
+        np.ndarray: Array of shape (T, W). Columns without any masked pixel are NaN.
+    """
+    T = sflow.n_frames
+    W = sflow.frame_shape[1]
+    out = np.full((T, W), np.nan)
+    for t in range(T):
+        _, xs, vecs = sflow.frame(t, channel)
+        if len(xs) == 0:
+            continue
+        vals = value_fn(vecs)
+        if method is np.mean:
+            counts = np.bincount(xs, minlength=W)
+            sums = np.bincount(xs, weights=vals, minlength=W)
+            hit = counts > 0
+            out[t, hit] = sums[hit] / counts[hit]
+        else:
+            order = np.argsort(xs, kind='stable')
+            cols, starts = np.unique(xs[order], return_index=True)
+            for col, seg in zip(cols, np.split(vals[order], starts[1:])):
+                out[t, col] = method(seg)
+    return out
+
+def vector_kymograph(arr, values=['x dir'], method=np.median, combine=True, save_path=None, channel=0):
     """
     Create and optionally combine kymographs from flow data.
+
+    arr is either a dense flow of shape (T, H, W, 2), a FlowResult or a SparseFlow. For a SparseFlow,
+    only the pixels inside the mask are used. For both, `channel` selects which channel to plot, and
+    a FlowResult reuses its cached magnitudes and angles.
     """
     if not any(val in values for val in ['x dir', 'y dir', 'mag', 'angle']):
         raise ValueError("values must be a subset of ['x dir', 'y dir', 'mag', 'angle']")
@@ -112,6 +152,25 @@ def vector_kymograph(arr, values=['x dir'], method=np.median, combine=True, save
 
     plots = []
 
+    if isinstance(arr, SparseFlow):
+        if 'x dir' in values:
+            plots.append((sparse_kymograph(arr, lambda v: v[:, 0], method, channel),
+                          'X Direction Kymograph', 'X Component of Velocity (px/frame)', 'PRGn'))
+        if 'y dir' in values:
+            plots.append((sparse_kymograph(arr, lambda v: v[:, 1], method, channel),
+                          'Y Direction Kymograph', 'Y Component of Velocity (px/frame)', 'PRGn'))
+        if 'mag' in values:
+            plots.append((sparse_kymograph(arr, lambda v: np.hypot(v[:, 0], v[:, 1]), method, channel),
+                          'Magnitude Kymograph', 'Speed (px/frame)', 'BuPu'))
+        if 'angle' in values:
+            plots.append((sparse_kymograph(arr, lambda v: np.arctan2(v[:, 1], v[:, 0]), method, channel),
+                          'Angle Kymograph', 'Direction (radians)', 'BuPu'))
+        values = [] # skip the dense branches below
+
+    result = None
+    if isinstance(arr, FlowResult):
+        result, arr = arr, arr.view(channel)
+
     if 'x dir' in values or 'y dir' in values:
         temp = np.array([method(arr[i, :, :, :], axis=0) for i in range(arr.shape[0])])
         if 'x dir' in values:
@@ -120,12 +179,12 @@ def vector_kymograph(arr, values=['x dir'], method=np.median, combine=True, save
             plots.append((temp[:, :, 1], 'Y Direction Kymograph', 'Y Component of Velocity (px/frame)', 'PRGn'))
 
     if 'mag' in values:
-        mag_per_frame = np.linalg.norm(arr, axis=3)
+        mag_per_frame = result.magnitude(channel=channel) if result is not None else np.linalg.norm(arr, axis=3)
         temp = np.array([method(mag_per_frame[i, :, :], axis=0) for i in range(arr.shape[0])])
         plots.append((temp, 'Magnitude Kymograph', 'Speed (px/frame)', 'BuPu'))
 
     if 'angle' in values:
-        angles_per_frame = np.arctan2(arr[:, :, :, 1], arr[:, :, :, 0])
+        angles_per_frame = result.angle(channel=channel) if result is not None else np.arctan2(arr[:, :, :, 1], arr[:, :, :, 0])
         temp = np.array([method(angles_per_frame[i, :, :], axis=0) for i in range(arr.shape[0])])
         plots.append((temp, 'Angle Kymograph', 'Direction (radians)', 'BuPu'))
 
@@ -143,33 +202,59 @@ def vector_kymograph(arr, values=['x dir'], method=np.median, combine=True, save
             plot_kymograph(data, title=title, label=label, cmap=cmap, save_path=save_path)
 
 # Heatmap
-def vector_magnitude_heatmaps(flow, normalize=True):
+def vector_magnitude_heatmaps(flow, normalize=True, governor=None, channel=0):
     """
     Computes magnitude heatmaps from a flow array of shape (frames, height, width, 2).
 
+    Magnitudes are computed in chunks of frames sized by the governor, so a memory-mapped
+    flow is never loaded as a whole. A SparseFlow is read directly, with zeros outside its mask, and
+    a FlowResult supplies its (cached) magnitudes.
+
     Args:
-        flow (np.ndarray): Array of shape (frames, height, width, 2) with (dx, dy) vectors.
-        apply_colormap (bool): If True, returns heatmaps with color (BGR, 3-channel).
+        flow (np.ndarray | FlowResult | SparseFlow): Array of shape (frames, height, width, 2) with (dx, dy) vectors.
         normalize (bool): If True, normalizes magnitudes to 0–255 range for visualization.
+        governor (ResourceGovernor, optional): Decides the chunk size. Default is a new governor.
+        channel (int): Channel to use if flow is a SparseFlow or a FlowResult with channels. Default is 0.
 
     Returns:
-        heatmaps (np.ndarray): Array of shape (frames, height, width) or (frames, height, width, 3)
-                               depending on apply_colormap.
+        heatmaps (np.ndarray): Array of shape (frames, height, width), uint8 if normalized.
     """
-    magnitudes = np.linalg.norm(flow, axis=-1)
-
-    if normalize:
-        heatmaps = []
-        for frame in magnitudes:
-            norm = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX)
-            norm = norm.astype(np.uint8)
-            heatmaps.append(norm)
-        heatmaps = np.stack(heatmaps, axis=0)
-    else:
-        heatmaps = magnitudes
+    if isinstance(flow, SparseFlow):
+        T, (H, W) = flow.n_frames, flow.frame_shape
+        heatmaps = np.zeros((T, H, W), dtype=np.uint8 if normalize else np.float32)
+        for t in range(T):
+            ys, xs, vecs = flow.frame(t, channel)
+            mags = np.hypot(vecs[:, 0], vecs[:, 1])
+            if normalize and len(mags) > 0:
+                span = mags.max() - mags.min()
+                mags = (mags - mags.min()) / span * 255 if span > 0 else np.zeros_like(mags)
+            heatmaps[t, ys, xs] = mags
+        return heatmaps
+
+    result = None
+    if isinstance(flow, FlowResult):
+        result, flow = flow, flow.view(channel)
+
+    governor = governor or ResourceGovernor()
+    T, H, W = flow.shape[:3]
+    chunk_size, _ = governor.plan('heatmaps', T, 2 * frame_bytes((H, W, 2), flow.dtype))
+
+    heatmaps = np.empty((T, H, W), dtype=np.uint8 if normalize else np.result_type(flow.dtype, np.float32))
+    for start in range(0, T, chunk_size):
+        stop = min(start + chunk_size, T)
+        if result is not None:
+            magnitudes = result.magnitude(slice(start, stop), channel)
+        else:
+            magnitudes = np.linalg.norm(flow[start:stop], axis=-1)
+        if normalize:
+            for i, frame in enumerate(magnitudes):
+                norm = cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX)
+                heatmaps[start + i] = norm.astype(np.uint8)
+        else:
+            heatmaps[start:stop] = magnitudes
     return heatmaps
 
-def save_heatmap_video(flow, output_path='heatmap_video.mp4', fps=10, normalize=True):
+def save_heatmap_video(flow, output_path='heatmap_video.mp4', fps=10, normalize=True, governor=None):
     """
     Saves a heatmap video (MP4) from a flow array using matplotlib.
 
@@ -178,11 +263,12 @@ def save_heatmap_video(flow, output_path='heatmap_video.mp4', fps=10, normalize=
         output_path (str): Path to save the MP4 video
         fps (int): Frames per second of the output video
         normalize (bool): Whether to normalize magnitudes per frame
+        governor (ResourceGovernor, optional): Decides the chunk size for computing heatmaps
 
     TODO: Seperate memory saving part
     TODO: Save to proper path
     """
-    heatmaps = vector_magnitude_heatmaps(flow, normalize=normalize)
+    heatmaps = vector_magnitude_heatmaps(flow, normalize=normalize, governor=governor)
 
     fig, ax = plt.subplots()
     im = ax.imshow(heatmaps[0], cmap='jet', animated=True)
@@ -1,6 +1,12 @@
 import numpy as np
 import cv2
 
+TRACK_NEW = 0   # feature detected in this frame
+TRACK_OK = 1    # feature tracked from the previous frame
+TRACK_LOST = 2  # tracking failed, position is the (rejected) estimate
+
+track_dtype = np.dtype([('id', np.int32), ('frame', np.int32), ('x', np.float32), ('y', np.float32), ('status', np.int8)])
+
 def trajectory(arr : np.array) -> np.array:
     """
     Dummy function to move onto other parts of the code.
@@ -11,4 +17,106 @@ def trajectory(arr : np.array) -> np.array:
     Returns:
         arr (np.array): Array with the trajectory computed.
     """
-    return arr
\ No newline at end of file
+    return arr
+
+def detect_features(frame : np.ndarray, n : int, mask : np.ndarray = None, **kwargs) -> np.ndarray:
+    """
+    Detects up to n corner features (Shi-Tomasi) in a frame.
+
+    Args:
+        frame (np.ndarray): uint8 frame (H, W).
+        n (int): Maximum number of features.
+        mask (np.ndarray, optional): uint8 mask, features are only detected where it is non-zero.
+        **kwargs: Dictionary with detection parameters:
+            - quality_level (float): minimal accepted corner quality relative to the best one. Default is 0.01.
+            - min_distance (int): minimal distance between features in pixels. Default is 7.
+            - block_size (int): neighbourhood size for the corner measure. Default is 7.
+
+    Returns:
+        np.ndarray: Array of shape (k, 1, 2) float32 with (x, y) positions, k <= n.
+    """
+    if n <= 0:
+        return np.empty((0, 1, 2), dtype=np.float32)
+    points = cv2.goodFeaturesToTrack(frame, maxCorners=n,
+                                     qualityLevel=kwargs.get('quality_level', 0.01),
+                                     minDistance=kwargs.get('min_distance', 7),
+                                     blockSize=kwargs.get('block_size', 7),
+                                     mask=mask)
+    if points is None:
+        return np.empty((0, 1, 2), dtype=np.float32)
+    return points.astype(np.float32)
+
+def track_features(arr : np.ndarray, **kwargs) -> np.ndarray:
+    """
+    Tracks sparse features through a stack with pyramidal Lucas-Kanade.
+
+    Features are detected in the first frame and followed frame to frame. Every step is checked
+    by tracking back to the previous frame; tracks whose forward-backward error exceeds
+    `fb_threshold` are ended with a TRACK_LOST row. Whenever fewer than `redetect` * `max_corners`
+    tracks are alive, new features are detected away from the existing ones and get new ids.
+
+    Args:
+        arr (np.ndarray): Stack of (preprocessed) frames (N, H, W). Converted to uint8 if needed.
+        **kwargs: Dictionary with tracking parameters (see defaults.default_tracking):
+            - max_corners (int): maximum number of live tracks. Default is 500.
+            - quality_level, min_distance, block_size: see detect_features.
+            - win_size (int): Lucas-Kanade search window size. Default is 21.
+            - max_level (int): number of pyramid levels. Default is 3.
+            - fb_threshold (float): maximum forward-backward error in pixels. Default is 1.0.
+            - redetect (float): fraction of max_corners below which features are re-detected. Default is 0.8.
+
+    Returns:
+        np.ndarray: Track table, a structured array with fields (id, frame, x, y, status).
+    """
+    max_corners = kwargs.get('max_corners', 500)
+    win_size = kwargs.get('win_size', 21)
+    lk_args = {'winSize': (win_size, win_size),
+               'maxLevel': kwargs.get('max_level', 3),
+               'criteria': (cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 30, 0.01)}
+    fb_threshold = kwargs.get('fb_threshold', 1.0)
+    redetect = kwargs.get('redetect', 0.8)
+    min_distance = kwargs.get('min_distance', 7)
+
+    def to_uint8(frame):
+        if frame.dtype == np.uint8:
+            return frame
+        return cv2.normalize(frame, None, 0, 255, cv2.NORM_MINMAX).astype(np.uint8)
+
+    rows = []
+    def record(ids, frame_idx, points, status):
+        for i, (x, y) in zip(ids, points.reshape(-1, 2)):
+            rows.append((i, frame_idx, x, y, status))
+
+    prev = to_uint8(arr[0])
+    points = detect_features(prev, max_corners, **kwargs)
+    ids = np.arange(len(points))
+    next_id = len(points)
+    record(ids, 0, points, TRACK_NEW)
+
+    for t in range(1, arr.shape[0]):
+        frame = to_uint8(arr[t])
+
+        if len(points) > 0:
+            new_points, st, _ = cv2.calcOpticalFlowPyrLK(prev, frame, points, None, **lk_args)
+            back_points, st_back, _ = cv2.calcOpticalFlowPyrLK(frame, prev, new_points, None, **lk_args)
+            fb_error = np.linalg.norm((points - back_points).reshape(-1, 2), axis=1)
+            good = (st.ravel() == 1) & (st_back.ravel() == 1) & (fb_error < fb_threshold)
+
+            record(ids[~good], t, new_points[~good], TRACK_LOST)
+            points, ids = new_points[good], ids[good]
+            record(ids, t, points, TRACK_OK)
+
+        if len(points) < redetect * max_corners:
+            mask = np.full(frame.shape, 255, dtype=np.uint8)
+            for x, y in points.reshape(-1, 2):
+                cv2.circle(mask, (int(round(x)), int(round(y))), min_distance, 0, -1)
+            found = detect_features(frame, max_corners - len(points), mask=mask, **kwargs)
+            new_ids = np.arange(next_id, next_id + len(found))
+            next_id += len(found)
+            record(new_ids, t, found, TRACK_NEW)
+            points = np.concatenate([points, found]).astype(np.float32)
+            ids = np.concatenate([ids, new_ids])
+
+        prev = frame
+
+    return np.array(rows, dtype=track_dtype)
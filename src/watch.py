@@ -0,0 +1,215 @@
+import os
+import json
+import time
+import numpy as np
+import tifffile as tiff
+from pathlib import Path
+import src.flow as flow
+import src.memory as mem
+from src.governor import ResourceGovernor
+from src.defaults import default_process, default_flow
+
+TIFF_SUFFIXES = ('.tif', '.tiff')
+
+class InboxWatcher():
+    def __init__(self, n_channels : int = 3, interval : float = 10.0, settle : int = 2,
+                 process_args : dict = None, flow_args : dict = None,
+                 governor : ResourceGovernor = None, inbox : Path = None):
+        """
+        Watches the CellFlow inbox and computes optical flow while TIFFs are still being written.
+
+        On every poll, each TIFF in the inbox is checked for newly completed frames. Only those pages
+        are read and preprocessed, the flow of the new frame pairs is computed (the last preprocessed
+        frame of the previous poll is kept for the pair that spans both polls), and the result is
+        appended to the stack's flow file in flow/. That file is a regular '<name>_fi.npy' that grows
+        as the acquisition runs (see memory.AppendableArray).
+
+        The last page of a growing file may be half written, so it only counts as complete once the
+        file size hasn't changed for `settle` polls. Progress is kept in '<name>/watch.json', so a
+        restarted watcher resumes the same flow file instead of starting over.
+
+        Args:
+            n_channels (int): Number of channels in the TIFF stacks. Default is 3.
+            interval (float): Seconds between polls. Default is 10.
+            settle (int): Polls without growth after which the last page counts as complete. Default is 2.
+            process_args (dict, optional): Preprocessing parameters. Default is the stack type's or default_process.
+            flow_args (dict, optional): Optical flow parameters. Default is the stack type's or default_flow.
+            governor (ResourceGovernor, optional): Memory/worker budget. Default is a new governor.
+            inbox (Path, optional): Folder to watch. Default is memory.inbox_path.
+
+        Attributes:
+            states (dict): Progress of every watched file, by path.
+        """
+        self.n_channels = n_channels
+        self.interval = interval
+        self.settle = settle
+        self.process_args = process_args
+        self.flow_args = flow_args
+        self.governor = governor if governor is not None else ResourceGovernor()
+        self.inbox = Path(inbox) if inbox is not None else mem.inbox_path
+        self.states = {}
+
+        if not mem.main_path.exists():
+            mem.init_memory()
+
+    @staticmethod
+    def _stacktype(name : str) -> str:
+        """
+        Cell type of a stack named 'DATE_CELLTYPE'.
+        """
+        parts = name.split('_', 1)
+        return parts[1] if len(parts) > 1 else name
+
+    def _state(self, path : Path) -> dict:
+        """
+        Returns the progress of a file, resuming from its watch.json if there is one.
+        """
+        if path in self.states:
+            return self.states[path]
+
+        name = path.stem
+        stacktype = self._stacktype(name)
+        params = mem.load_params(stacktype)
+        state = {'name': name, 'frames': 0, 'flow': None, 'size': -1, 'stable': 0, 'last': {},
+                 'process': self.process_args or params.get('preprocess', default_process),
+                 'optical_flow': self.flow_args or params.get('optical_flow', default_flow)}
+
+        watch_path = mem.main_path / name / 'watch.json'
+        if watch_path.exists():
+            with open(watch_path, 'r') as f:
+                saved = json.load(f)
+            state['flow'] = mem.AppendableArray(mem.main_path / name / 'flow' / saved['flow'])
+            # the flow file is appended before watch.json is written, so it is the one to trust
+            # after a crash: n flow frames means n + 1 frames were processed
+            length = state['flow'].length
+            state['frames'] = length + 1 if length > 0 else saved['frames']
+        else:
+            mem.save_type(stacktype, params)
+            mem.save_meta(str(path), stacktype, name)
+
+        self.states[path] = state
+        return state
+
+    def _save_state(self, state : dict) -> None:
+        """
+        Writes watch.json atomically, so a watcher killed mid-write never leaves a truncated file.
+        """
+        watch_path = mem.main_path / state['name'] / 'watch.json'
+        tmp_path = watch_path.with_suffix('.json.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'flow': state['flow'].path.name, 'frames': state['frames']}, f, indent=2)
+        os.replace(tmp_path, watch_path)
+
+    def _read_new_frames(self, path : Path, state : dict) -> np.ndarray:
+        """
+        Reads the frames completed since the last poll (plus the last old frame when resuming).
+
+        Returns:
+            tuple: (frames, n_frames), frames of shape (k, n_channels, H, W) or None if nothing new is
+            complete, and n_frames the number of complete frames in the file.
+        """
+        size = path.stat().st_size
+        state['stable'] = state['stable'] + 1 if size == state['size'] else 0
+        state['size'] = size
+
+        with tiff.TiffFile(path) as img:
+            n_pages = len(img.pages)
+            complete = n_pages if state['stable'] >= self.settle else n_pages - 1
+            n_frames = complete // self.n_channels
+            if n_frames <= state['frames']:
+                return None, n_frames
+            # a resumed watcher lost its last preprocessed frame, so it's read again
+            first = state['frames'] - 1 if state['frames'] > 0 and not state['last'] else state['frames']
+            frames = np.stack([
+                np.stack([img.pages[i * self.n_channels + c].asarray() for c in range(self.n_channels)])
+                for i in range(first, n_frames)])
+        return frames, n_frames
+
+    def update(self, path : Path) -> int:
+        """
+        Processes the newly completed frames of one file.
+
+        Args:
+            path (Path): TIFF file.
+
+        Returns:
+            int: Number of flow frames appended.
+        """
+        state = self._state(path)
+        try:
+            frames, n_frames = self._read_new_frames(path, state)
+        except Exception as e:
+            # the microscope may be in the middle of writing a page header
+            print(f"[WARNING] Could not read {path.name} yet: {e}")
+            return 0
+        if frames is None:
+            return 0
+
+        flows = []
+        for channel_idx in (1, 2):
+            processed = flow.preprocess_stack(frames[:, channel_idx], governor=self.governor, **state['process'])
+            if channel_idx in state['last']:
+                processed = np.concatenate([state['last'][channel_idx][None], processed])
+            state['last'][channel_idx] = processed[-1]
+            if processed.shape[0] > 1:
+                flow_args = state['optical_flow']
+                flows.append(flow.optical_flow(
+                    processed,
+                    flow_args['pyr_scale'],
+                    flow_args['levels'],
+                    flow_args['winsize'],
+                    flow_args['iterations'],
+                    flow_args['poly_n'],
+                    flow_args['poly_sigma'],
+                    flow_args['flag'],
+                    governor=self.governor
+                ))
+
+        if state['flow'] is None:
+            name = state['name']
+            flow_path = mem.get_unique_path(name, 'flow', lambda i: f"{name}_f{i}.npy", aliases=('.npz',))
+            state['flow'] = mem.AppendableArray(flow_path, (3,) + frames.shape[2:] + (2,))
+
+        n_new = 0
+        if flows:
+            combined = flow.combine_flows(flows)
+            state['flow'].append(combined)
+            n_new = combined.shape[0]
+        state['frames'] = n_frames
+        self._save_state(state)
+        return n_new
+
+    def poll(self) -> dict:
+        """
+        Checks every TIFF in the inbox once.
+
+        Returns:
+            dict: {name: number of flow frames appended} for the files that grew.
+        """
+        updated = {}
+        for path in sorted(self.inbox.iterdir()):
+            if path.suffix.lower() not in TIFF_SUFFIXES:
+                continue
+            n_new = self.update(path)
+            if n_new:
+                updated[path.stem] = n_new
+                self.governor.log(f"watch: {path.stem} +{n_new} flow frames ({self.states[path]['flow'].length} total)")
+        return updated
+
+    def run(self, duration : float = None) -> None:
+        """
+        Polls the inbox every `interval` seconds until `duration` has passed or Ctrl+C is pressed.
+
+        Args:
+            duration (float, optional): Seconds to run for. Default is None (until interrupted).
+
+        Returns:
+            None
+        """
+        start = time.monotonic()
+        try:
+            while duration is None or time.monotonic() - start < duration:
+                self.poll()
+                time.sleep(self.interval)
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,136 @@
+import queue
+import threading
+import numpy as np
+
+class AsyncWriter():
+    def __init__(self, max_pending : int = 4):
+        """
+        Background writer that moves disk I/O off the calling thread.
+
+        Jobs are handed to a single worker thread through a bounded queue, so at most
+        `max_pending` writes can be waiting at once. Once the queue is full, `submit` blocks
+        until the worker catches up, which keeps memory from growing without bound when the
+        disk is slower than the computation.
+
+        Args:
+            max_pending (int): Maximum number of queued writes before `submit` blocks. Default is 4.
+
+        Attributes:
+            max_pending (int): Size of the write queue.
+        """
+        self.max_pending = max_pending
+        self._queue = queue.Queue(maxsize=max_pending)
+        self._errors = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # don't mask the caller's exception with a write error
+        self.close(raise_errors=exc_type is None)
+
+    def _run(self) -> None:
+        """
+        Worker loop. Runs queued jobs in order until the stop sentinel (None) is received.
+        """
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs = job
+                func(*args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def _raise_errors(self) -> None:
+        """
+        Re-raises the first write error collected by the worker thread, if any.
+        """
+        with self._lock:
+            if not self._errors:
+                return
+            error = self._errors[0]
+            self._errors = []
+        raise error
+
+    def submit(self, func, *args, **kwargs) -> None:
+        """
+        Queues a write job. Blocks if `max_pending` jobs are already waiting.
+
+        The arguments are not copied, so arrays passed here must not be modified by the caller
+        until the write has completed (see `flush`).
+
+        Args:
+            func (callable): Function that performs the write, e.g. np.save.
+            *args: Positional arguments for func.
+            **kwargs: Keyword arguments for func.
+
+        Returns:
+            None
+        """
+        if self._closed:
+            raise RuntimeError("Cannot submit to a closed AsyncWriter")
+        self._raise_errors()
+        self._queue.put((func, args, kwargs))
+
+    def write_chunk(self, target : np.ndarray, start : int, chunk : np.ndarray) -> None:
+        """
+        Queues a write of `chunk` into `target[start:start + len(chunk)]`.
+
+        `target` is expected to be a memory-mapped array (see `memory.open_array`), so this lets
+        a large artifact be written frame block by frame block while the next block is computed.
+
+        Args:
+            target (np.ndarray): Array (usually a np.memmap) to write into.
+            start (int): Index along the first axis where the chunk begins.
+            chunk (np.ndarray): Data to write.
+
+        Returns:
+            None
+        """
+        self.submit(_assign, target, start, chunk)
+
+    def flush(self) -> None:
+        """
+        Waits for every queued write to finish and re-raises the first error that occurred.
+
+        Returns:
+            None
+        """
+        self._queue.join()
+        self._raise_errors()
+
+    def close(self, raise_errors : bool = True) -> None:
+        """
+        Flushes all pending writes and stops the worker thread.
+
+        Args:
+            raise_errors (bool): Re-raise any write error after stopping. Default is True.
+
+        Returns:
+            None
+        """
+        if self._closed:
+            return
+        self._queue.join()
+        self._closed = True
+        self._queue.put(None)
+        self._thread.join()
+        if raise_errors:
+            self._raise_errors()
+
+def _assign(target : np.ndarray, start : int, chunk : np.ndarray) -> None:
+    """
+    Writes a chunk into a (memory-mapped) array and flushes it to disk.
+    """
+    target[start:start + chunk.shape[0]] = chunk
+    if isinstance(target, np.memmap):
+        target.flush()